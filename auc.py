@@ -77,6 +77,9 @@ def roc(s, seed_list, target_list, sa):
 
     """
     Takes a similarity matrix s, a seed gene list, a target gene list,
+    and sa, a boolean gene presence array aligned to s.gene_names (see ctalk.get_sa)
+
+    sa may be a masked array, masking genes without a presence definition. Throws a KeyError if any of these is a target
 
     Returns a set of (score, label) tuples, where label is 1 for pos and 0 for neg
     Suitable for CROC ScoreData object
@@ -91,46 +94,51 @@ def roc(s, seed_list, target_list, sa):
     #    print(target_list)
     #    raise ValueError, 'Unable to find seed and/or target lists in sdata!'
 
-    gl1set = set(seed_list)
-    gl2set = set(target_list)
-
-    genes  = set(s.gene_names)
-
-    union = gl1set & gl2set
+    gl1 = _gene_mask(s, seed_list)
+    gl2 = _gene_mask(s, target_list)
 
     # Consider only genes which are not in the seed list, unless they are found in both seed and target list
-    q = s.get_samples(seed_list).get_features(list( (genes ^ (genes & gl1set)) | union ))
-    weights = q.M.sum(0)
+    rows = clustio.index_intersect(s.sample_index, seed_list)
+    cols = N.flatnonzero(~gl1 | gl2)
 
-    c = 1000000 # Dummy gene starter value
-    wadd = []
-    gadd = []
+    weights = clustio.parsers.ParserView(s, rows, cols).M.sum(0)
+    present = N.ma.getdata(sa).take(cols)
+    target  = gl2.take(cols)
+
+    if N.ma.getmask(sa) is not N.ma.nomask:
+        undefined = cols[target & N.ma.getmask(sa).take(cols)]
+        if len(undefined):
+            raise KeyError, 'No presence definition for target genes %s' % ', '.join(s.gene_names.take(undefined))
 
     # Reweight genes which overlap and are present in the sample set to be infinite
-    # Reweight genes which appear in the target set to be 0, and replace them with dummy targets
-    for i in xrange(len(weights)):
-        if q.gene_names[i] in union and sa[q.gene_names[i]]:
-            weights[i] = sys.maxint
-        if q.gene_names[i] in gl2set and not sa[q.gene_names[i]]:
-            
-            # Add gene to end, with 0 weight
-            wadd.append(0)
-            gadd.append(q.gene_names[i])
+    weights[gl1.take(cols) & target & present] = sys.maxint
 
-            # Current weight gene becomes dummy
-            q.gene_names[i] = '%s' % c
-            c += 1
+    # Reweight genes which appear in the target set but are absent to be 0: they stay in place as
+    # non-target dummies and are added again at the end as 0-weight targets
+    absent = target & ~present
+    labels = (target & present).astype(int)
 
-    weights = list(weights) + wadd
-    q.gene_names = list(q.gene_names) + gadd
+    if absent.any():
+        weights = N.concatenate((weights, N.zeros(absent.sum())))
+        labels  = N.concatenate((labels, N.ones(absent.sum(), dtype=int)))
 
-    return N.array(weights), N.array([ int(x in gl2set) for x in q.gene_names ])
+    return weights, labels
 
     # Jul 30 2014 return changed for new AUC method
     #weights = [ (weights[i], q.gene_names[i] in gl2set) for i in xrange(len(weights)) ]
 
     #return weights
 
+def _gene_mask(s, names):
+    """Returns a boolean array over s.gene_names, True for the genes found in names"""
+
+    gene_index = s.gene_index
+
+    mask = N.zeros(len(gene_index), dtype=bool)
+    mask[[ gene_index[x] for x in set(names) if x in gene_index ]] = True
+
+    return mask
+
 def predictability_roc(s, gl1, gl2, sa, similarity=False):
     """
     
@@ -158,9 +166,9 @@ def predictability_roc(s, gl1, gl2, sa, similarity=False):
     else:
         Q = s.M.copy()
 
-    # Create a new s object for convenience, certainly not efficient
+    # Create a new s object for convenience
     c = clustio.parsers.NullParser()
-    c.samples = [ clustio.parsers.SampleData(sample_id=x) for x in s.gene_names ]
+    c.samples = clustio.parsers.SampleTable(s.gene_names)
     c.gene_names = s.gene_names.copy()
     c.M = Q
 
@@ -182,6 +190,84 @@ def mutual(roc1, roc2):
 
     return N.sqrt(auc(roc1) * auc(roc2))
 
+def mutual_matrix(M):
+    """
+
+    Calculates the mutual predictability of every pair in an asymmetric AUC matrix M,
+    the element-wise geometric mean of M and M.T. The diagonal is left unchanged.
+
+    Returns a new symmetric matrix of the same dtype as M
+
+    """
+
+    Q = N.sqrt(M * M.T)
+    N.fill_diagonal(Q, M.diagonal())
+
+    return Q
+
+def threshold_matrix(path_names, pathway_dict, thresholds):
+    """
+
+    Builds a symmetric threshold matrix T for the pathways in path_names, where T[i][j] is the value
+    in thresholds for the (len(pi), len(pj), len(pi & pj)) triple describing pathways i and j,
+    as produced by auc_perm.mp_auc_matrix. The diagonal is left at zero.
+
+    Raises a KeyError if a pathway pair's triple is missing from thresholds
+
+    """
+
+    psets  = [ set(pathway_dict[x]) for x in path_names ]
+    gidx   = dict([ (g, i) for i, g in enumerate(set().union(*psets)) ])
+
+    # Pathway membership matrix, float32 so the overlap product goes through BLAS. Exact for counts < 2**24
+    P = N.zeros((len(psets), len(gidx)), dtype=N.float32)
+    for k in xrange(len(psets)):
+        P[k, [ gidx[g] for g in psets[k] ]] = 1
+
+    overlaps = P.dot(P.T).astype(N.int64)
+    sizes    = overlaps.diagonal().copy()
+
+    i, j = N.triu_indices(len(psets), 1)
+    si, sj, so = sizes[i], sizes[j], overlaps[i, j]
+
+    # Only the distinct triples need a table lookup
+    base = sizes.max() + 1 if len(sizes) else 1
+    keys, inv = N.unique((si * base + sj) * base + so, return_inverse=True)
+    first = N.zeros(len(keys), dtype=N.int64)
+    first[inv] = N.arange(len(inv))
+    vals  = N.array([ thresholds[(int(si[k]), int(sj[k]), int(so[k]))] for k in first ], dtype=N.float64)
+
+    T = N.zeros((len(psets), len(psets)), dtype=N.float64)
+    T[i, j] = T[j, i] = vals[inv]
+
+    return T
+
+def mask_matrix(M, T, inclusive=True):
+    """
+
+    Zeroes each symmetric pair M[i][j], M[j][i] (i < j) where M[i][j] is below T, or equal to T if inclusive is True.
+    T may be a scalar or a matrix the same shape as M. Comparisons are made in double precision.
+
+    Modifies M in place and returns it
+
+    """
+
+    i, j = N.triu_indices(len(M), 1)
+    v = M[i, j].astype(N.float64)
+
+    if N.ndim(T):
+        T = T[i, j]
+
+    if inclusive:
+        mask = v <= T
+    else:
+        mask = v < T
+
+    M[i[mask], j[mask]] = 0
+    M[j[mask], i[mask]] = 0
+
+    return M
+
 def _auc(roc, sweep_method='smooth'):
     """
 
@@ -26,7 +26,6 @@ import clustio, scripts
 
 import numpy as N
 import multiprocessing as mp
-from itertools import combinations as comb
 from itertools import combinations_with_replacement as combr
 
 from auc import roc, mutual, auc
@@ -42,20 +41,20 @@ def findpathwaysizes(fn1, fn2, pathway_dict, sizes, threshold):
     mutualize(mat1)
     mutualize(mat2)
     M = N.abs(mat1.M - mat2.M)
-    res = []
     nd = {}
     for i in xrange(len(sizes)):
         nd[sizes[i]] = i
-    for i, j in comb(xrange(len(M)), 2):
-        if M[i][j] >= threshold:
-            res.append(list(sorted([ nd[len(pathway_dict[mat1.gene_names[i]])], nd[len(pathway_dict[mat1.gene_names[j]])] ])))
+    sidx = N.array([ nd[len(pathway_dict[x])] for x in mat1.gene_names ], dtype=int)
+    i, j = N.triu_indices(len(M), 1)
+    keep = M[i, j].astype(N.float64) >= threshold
+    res  = N.sort(N.column_stack((sidx[i[keep]], sidx[j[keep]])), 1).tolist()
     #return list(set([ tuple(x) for x in res if (N.array(x) > 16).all() and (N.array(x) < 350).all() ]))
     return list(set([ tuple(x) for x in res ]))
 
 def permcomp_by_size(fn1, fn2, fln, p1size, p2size, iter=1000):
-    sa1 = get_sa(fn1)
-    sa2 = get_sa(fn2)
-    assert set(sa1.keys()) == set(sa2.keys())
+    sa1 = get_sa(fn1, fln.gene_names)
+    sa2 = get_sa(fn2, fln.gene_names)
+    assert (N.ma.getmaskarray(sa1) == N.ma.getmaskarray(sa2)).all()
     results = []
     seedmat = N.random.rand(2, 2)
     Q1 = mp_auc_matrix(fln, [p1size, p2size], sa1, similarity=True, seedmat = seedmat, iter=iter)
@@ -63,9 +62,9 @@ def permcomp_by_size(fn1, fn2, fln, p1size, p2size, iter=1000):
     return Q1, Q2
 
 def permcomp(fn1, fn2, fln, pathway_dict, sizes, threshold=0.0, procs=mp.cpu_count(), iter=100):
-    sa1 = get_sa(fn1)
-    sa2 = get_sa(fn2)
-    assert set(sa1.keys()) == set(sa2.keys())
+    sa1 = get_sa(fn1, fln.gene_names)
+    sa2 = get_sa(fn2, fln.gene_names)
+    assert (N.ma.getmaskarray(sa1) == N.ma.getmaskarray(sa2)).all()
 
     # Dec 30 2014 currently on hold while we work out how this is going to go
     #pairs = findpathwaysizes(fn1, fn2, pathway_dict, sizes, threshold)
@@ -105,7 +104,7 @@ def predictability_perm_roc(s, size1, size2, overlap, sa, iter, similarity, seed
 
     # Create a new s object for convenience, certainly not efficient
     c = clustio.parsers.NullParser()
-    c.samples = [ clustio.parsers.SampleData(sample_id=x) for x in s.gene_names ]
+    c.samples = clustio.parsers.SampleTable(s.gene_names)
     c.gene_names = s.gene_names.copy()
     c.M = Q
 
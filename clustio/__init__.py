@@ -21,6 +21,6 @@ along with ConsensusCluster.  If not, see <http://www.gnu.org/licenses/>.
 
 
 """
-from ioutils    import get_indices, argintersect, list_or_files
-from writeutils import write_normal, write_table, write_list
-from parsers    import ParseNormal, read_table, read_list, read_cluster_log
+from ioutils    import get_indices, argintersect, index_intersect, list_or_files, open_file, strip_compression_ext
+from writeutils import write_normal, write_native, write_edges, write_table, write_list
+from parsers    import ParseNormal, ParseNative, ParseEdges, read_table, read_list, read_edges, read_cluster_log, read_normal_chunks, merge_all
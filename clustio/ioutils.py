@@ -24,10 +24,258 @@ along with ConsensusCluster.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import os
+import os, zlib, bz2, threading, Queue
 import numpy as N
 import parsers
 
+from collections import deque
+
+STREAM_BLOCKSIZE = 1 << 18  # Compressed bytes read at a time by the decompression thread
+STREAM_DEPTH     = 8        # Decompressed blocks allowed to queue up ahead of the reader
+STREAM_OUTSIZE   = 1 << 20  # Most decompressed bytes in a queued block, so the queue's memory use is bounded
+STREAM_BZ2_PIECE = 1 << 10  # Compressed bytes fed to bz2 at a time, since it has no output limit of its own
+
+def compression(filename):
+    """Returns 'gzip' or 'bz2' if filename is compressed (judged by its magic number, not its name), else None"""
+
+    f = open(filename, 'rb')
+    magic = f.read(3)
+    f.close()
+
+    if magic[:2] == '\x1f\x8b':
+        return 'gzip'
+    if magic == 'BZh':
+        return 'bz2'
+    return None
+
+def open_file(filename):
+    """
+
+    Open filename for reading text, transparently decompressing gzip or bz2 files.
+
+    Compressed files are decompressed by a background thread a block at a time, so decompression
+    overlaps with whatever the caller does with each line (both zlib and bz2 release the GIL).
+    Uncompressed files are simply opened.
+
+    Returns a file-like object supporting iteration, readline, read and close
+
+    """
+
+    kind = compression(filename)
+
+    if kind is None:
+        return open(filename, 'r')
+
+    return DecompressingReader(filename, kind)
+
+def strip_compression_ext(filename):
+    """Remove a trailing .gz or .bz2 extension from filename, if any"""
+
+    base, ext = os.path.splitext(filename)
+
+    if ext.lower() in ('.gz', '.bz2'):
+        return base
+    return filename
+
+
+class DecompressingReader(object):
+    """
+
+    DecompressingReader(filename, kind)
+
+        Read-only file-like object over a gzip or bz2 file, where kind is 'gzip' or 'bz2'.
+        See open_file.
+
+        Concatenated (multi-member) streams are read in full, as gzip -d would. A truncated stream
+        raises an IOError once the data before the cut has been read.
+
+    """
+
+    def __init__(self, filename, kind):
+
+        self.name   = filename
+        self.kind   = kind
+        self.closed = False
+
+        self._raw   = open(filename, 'rb')
+        self._queue = Queue.Queue(STREAM_DEPTH)
+        self._lines = deque()
+        self._tail  = ''
+        self._done  = False
+
+        self._thread = threading.Thread(target=self._decompress)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _decompressor(self):
+
+        if self.kind == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return bz2.BZ2Decompressor()
+
+    def _decompress_step(self, d, chunk):
+        """
+
+        Decompresses the start of chunk with d, giving at most STREAM_OUTSIZE bytes for gzip, or one STREAM_BZ2_PIECE
+        of input for bz2. Returns (output, the part of chunk not yet fed to d), where anything past the end of
+        the compressed stream is left in d.unused_data instead
+
+        """
+
+        if self.kind == 'gzip':
+            out = d.decompress(chunk, STREAM_OUTSIZE)
+
+            # At the end of the stream zlib leaves the remaining input in both attributes
+            if d.unused_data:
+                return out, ''
+            return out, d.unconsumed_tail
+
+        return d.decompress(chunk[:STREAM_BZ2_PIECE]), chunk[STREAM_BZ2_PIECE:]
+
+    def _at_end(self, d):
+        """
+
+        Returns True if d has reached the end of its compressed stream. Checked by giving it one more byte,
+        which bz2 refuses and zlib sets aside as unused_data once the stream is complete
+
+        """
+
+        try:
+            d.decompress('\0')
+        except EOFError:
+            return True
+        except Exception:
+            return False
+
+        return bool(d.unused_data)
+
+    def _decompress(self):
+        """
+
+        Background thread: decompress the raw file into self._queue, ending with None (or the exception raised).
+        Both the number of queued blocks and the size of each are limited, so memory use stays bounded
+        however well the file compresses
+
+        """
+
+        try:
+            d     = self._decompressor()
+            fresh = True  # Nothing has been fed to d yet
+
+            for chunk in iter(lambda: self._raw.read(STREAM_BLOCKSIZE), ''):
+                if self.closed:
+                    return
+
+                while chunk:
+                    if self.closed:
+                        return
+
+                    try:
+                        out, rest = self._decompress_step(d, chunk)
+                    except EOFError:
+                        # bz2 member ended exactly on a block boundary
+                        d = self._decompressor()
+                        fresh = True
+                        continue
+
+                    fresh = False
+
+                    for i in xrange(0, len(out), STREAM_OUTSIZE):
+                        self._queue.put(out[i:i + STREAM_OUTSIZE])
+
+                    # Anything past the end of a member is the start of the next one
+                    chunk = rest
+                    if d.unused_data:
+                        chunk = d.unused_data + rest
+                        d = self._decompressor()
+                        fresh = True
+
+            if not fresh and not self._at_end(d):
+                raise IOError('compressed stream ended early, the file is truncated')
+
+            self._queue.put(None)
+
+        except Exception, e:
+            self._queue.put(e)
+
+    def _fill(self):
+        """Split the next decompressed block into lines. Returns False once there is nothing left to read"""
+
+        if self._done:
+            return False
+
+        block = self._queue.get()
+
+        if isinstance(block, Exception):
+            self._done = True
+            raise IOError('Error decompressing %s: %s' % (self.name, block))
+
+        if block is None:
+            self._done = True
+            if self._tail:
+                self._lines.append(self._tail)
+                self._tail = ''
+            return True
+
+        lines = (self._tail + block).split('\n')
+        self._tail = lines.pop()
+        self._lines.extend([ x + '\n' for x in lines ])
+
+        return True
+
+    def __iter__(self):
+
+        while True:
+            while self._lines:
+                yield self._lines.popleft()
+
+            if not self._fill():
+                return
+
+    def readline(self):
+
+        while not self._lines:
+            if not self._fill():
+                return ''
+
+        return self._lines.popleft()
+
+    def read(self, size=-1):
+
+        chunks = []
+        have   = 0
+
+        while size < 0 or have < size:
+            if not self._lines:
+                if not self._fill():
+                    break
+                continue
+
+            line = self._lines.popleft()
+            chunks.append(line)
+            have += len(line)
+
+        data = ''.join(chunks)
+
+        if size >= 0 and len(data) > size:
+            self._lines.appendleft(data[size:])
+            data = data[:size]
+
+        return data
+
+    def close(self):
+
+        self.closed = True
+
+        # Unblock the decompression thread if it is waiting on a full queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+        self._raw.close()
+
 def new_filename(filename, default, extension):
     """Try to avoid squashing old files by incrementing -num extensions to the filename"""
 
@@ -138,6 +386,20 @@ def argintersect(list1, list2):
 
     return [ x[0] for x in N.argwhere(N.in1d(list1, list2, assume_unique=True)) ]
 
+def index_intersect(index, names):
+    """
+
+    Same as argintersect(list1, names), where index is a dict of list1 item -> position in list1,
+    such as BaseParser.gene_index or BaseParser.sample_index. Runs in time proportional to len(names).
+
+    Throws an error if names is not unique
+
+    """
+
+    if len(set(names)) != len(names):
+        raise ValueError, 'One or more sets contain non-unique elements'
+
+    return sorted([ index[x] for x in names if x in index ])
 
 def get_indices(s, filename):
     """
@@ -148,5 +410,5 @@ def get_indices(s, filename):
     sams = list_or_files(filename)
     name = sams.keys()[0]
     
-    return name, argintersect([ x.sample_id for x in s.samples ], sams[name])
+    return name, index_intersect(s.sample_index, sams[name])
 
@@ -25,9 +25,165 @@ along with ConsensusCluster.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import sys
-import numpy as N
-import ioutils
+import os, sys, mmap, hashlib, Queue
+import numpy   as N
+import cPickle as cp
+import multiprocessing as mp
+import ioutils, writeutils
+
+from warnings  import warn
+from itertools import islice, chain, izip
+from collections import deque
+
+SIDECAR_EXTENSION  = '.sdata'   # Appended to the parsed filename to create the binary sidecar
+USE_SIDECAR        = True       # Default for ParseNormal(cache=...)
+CHUNKSIZE          = 1024       # Rows per block when streaming tab-delimited files
+PARALLEL_MIN_BYTES = 1 << 24    # Smaller files are not worth parsing in parallel
+PARALLEL_POLL      = 1.0        # Seconds between checks that parsing workers are still alive
+
+SAMPLE_FIELDS      = ('sample_id', 'sample_num', 'sample_class', 'cluster_id', 'index') # SampleData attributes, one SampleTable column each
+
+def _file_key(filename, digest=True):
+    """
+
+    Identify the contents of filename by (size, mtime, md5 hexdigest)
+    If digest is False, the hash is left as None, which avoids a complete pass over the file
+
+    """
+
+    st = os.stat(filename)
+    md5 = None
+
+    if digest:
+        h = hashlib.md5()
+        f = open(filename, 'rb')
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            h.update(chunk)
+        f.close()
+        md5 = h.hexdigest()
+
+    return (st.st_size, st.st_mtime, md5)
+
+def _write_sidecar(sdata, data_file):
+    """
+
+    Write sdata to a binary sidecar next to data_file, keyed on the current size, mtime and content
+    hash of data_file. The sidecar is in the writeutils.write_native format.
+
+    Failure to write (e.g., a read-only directory) is not an error.
+
+    """
+
+    sidecar = data_file + SIDECAR_EXTENSION
+    tmpname = '%s.%s.tmp' % (sidecar, os.getpid())
+
+    try:
+        writeutils.write_native(sdata, tmpname, key=_file_key(data_file))
+        os.rename(tmpname, sidecar)
+    except (IOError, OSError), e:
+        warn('Unable to write sidecar cache %s: %s' % (sidecar, e))
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+
+def _read_sidecar(data_file):
+    """
+
+    Returns (M, meta) from the sidecar of data_file, or None if there is no sidecar or it is out of date.
+
+    M is memory-mapped copy-on-write, so pages are shared between processes loading the same file
+    and in-place modification never reaches the disk.
+
+    """
+
+    sidecar = data_file + SIDECAR_EXTENSION
+
+    if not os.path.exists(sidecar):
+        return None
+
+    try:
+        M, meta = read_native(sidecar, mmap_mode='c')
+    except Exception:
+        return None
+
+    if meta.get('key') is None:
+        return None
+
+    size, mtime, md5 = meta['key']
+    cur_size, cur_mtime, _ = _file_key(data_file, digest=False)
+
+    if size != cur_size:
+        return None
+
+    # Same size but touched or copied, so fall back on the content hash
+    if mtime != cur_mtime and md5 != _file_key(data_file)[2]:
+        return None
+
+    return M, meta
+
+def read_native(filename, mmap_mode='r'):
+    """
+
+    read_native(filename, mmap_mode)
+
+        Read a binary file written by writeutils.write_native.
+
+        mmap_mode is passed to numpy.memmap: 'r' maps the matrix read-only, 'c' maps it copy-on-write,
+        and None reads it into memory instead. Mapped matrices are shared between processes, and only
+        the pages actually indexed are ever read from disk.
+
+    Returns: A tuple of (M, meta), where meta is a dict holding at least gene_names and sample_ids
+
+    """
+
+    f = open(filename, 'rb')
+
+    try:
+        if N.lib.format.read_magic(f) == (1, 0):
+            shape, fortran, dtype = N.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = N.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        nbytes = int(N.prod(shape)) * dtype.itemsize
+
+        f.seek(offset + nbytes)
+        meta = cp.load(f)
+
+        if mmap_mode is None or not nbytes:
+            f.seek(offset)
+            M = N.fromfile(f, dtype=dtype, count=int(N.prod(shape))).reshape(shape, order=fortran and 'F' or 'C')
+        else:
+            M = N.memmap(filename, dtype=dtype, mode=mmap_mode, offset=offset, shape=shape, order=fortran and 'F' or 'C').view(N.ndarray)
+    finally:
+        f.close()
+
+    return M, meta
+
+def read_edges(filename):
+    """
+
+    read_edges(filename)
+
+        Read a sparse network written by writeutils.write_edges.
+
+    Returns: A tuple of (names, I, J, weights, categories), where I and J index names and
+             categories is an array of category strings aligned to them
+
+    """
+
+    f = N.load(filename)
+
+    try:
+        names      = f['names']
+        I          = f['i'].astype(N.intp)
+        J          = f['j'].astype(N.intp)
+        weights    = f['weight']
+        categories = f['categories'].take(f['category'])
+    finally:
+        f.close()
+
+    return names, I, J, weights, categories
 
 def read_cluster_log(log):
     """Get clusters in dict format from log"""
@@ -64,7 +220,7 @@ def read_table(filename):
 
     conv = dict()
 
-    handle = open(filename, 'r')
+    handle = ioutils.open_file(filename)
 
     for line in handle:
         a = line.split("\t")
@@ -83,17 +239,261 @@ def read_list(filename):
     read_list(filename)
 
         Simply returns a concatenated list of every line in filename, with the newlines stripped
+        filename may be gzip or bz2 compressed
 
     Returns: A list of strings
 
     """
 
-    handle = open(filename, 'r')
+    handle = ioutils.open_file(filename)
     entries = [ x.strip() for x in handle ]
     handle.close()
 
     return entries
 
+def _count_lines(filename, start=0, end=None):
+    """Count the lines in filename (or in its byte range [start, end)) with a raw byte scan, without parsing anything"""
+
+    size = os.path.getsize(filename)
+
+    if end is None:
+        end = size
+
+    f = open(filename, 'rb')
+    f.seek(start)
+
+    count = 0
+    last  = ''
+    left  = end - start
+
+    while left > 0:
+        buf = f.read(min(1 << 20, left))
+        if not buf:
+            break
+        count += buf.count('\n')
+        left  -= len(buf)
+        last   = buf
+
+    f.close()
+
+    # An unterminated last line
+    if end == size and last and last[-1] != '\n':
+        count += 1
+
+    return count
+
+def _split_ranges(filename, start, nparts):
+    """Split filename from byte offset start to its end into up to nparts byte ranges, each beginning on a new line"""
+
+    size   = os.path.getsize(filename)
+    bounds = [start]
+
+    f = open(filename, 'rb')
+
+    for k in xrange(1, nparts):
+        f.seek(start + (size - start) * k // nparts)
+        f.readline()
+        pos = f.tell()
+
+        if bounds[-1] < pos < size:
+            bounds.append(pos)
+
+    f.close()
+
+    bounds.append(size)
+
+    return zip(bounds[:-1], bounds[1:])
+
+def _read_range(filename, start, end, blocksize=1 << 22):
+    """Yield the lines of filename in the byte range [start, end)"""
+
+    f = open(filename, 'rb')
+    f.seek(start)
+
+    left = end - start
+    tail = ''
+
+    while left > 0:
+        buf = f.read(min(blocksize, left))
+        if not buf:
+            break
+        left -= len(buf)
+
+        lines = (tail + buf).split('\n')
+        tail  = lines.pop()
+
+        for line in lines:
+            yield line
+
+    f.close()
+
+    if tail:
+        yield tail
+
+def _parse_range(filename, start, end, nsamples, buf, shape, col, rq, num):
+    """Worker process for _parse_parallel. Parses a byte range into the shared matrix from column col onwards"""
+
+    try:
+        M = N.frombuffer(buf, dtype=N.float32).reshape(shape)
+        gene_names = []
+
+        for names, B in _iter_rows(_read_range(filename, start, end), nsamples):
+            M[:, col + len(gene_names):col + len(gene_names) + len(names)] = B.T
+            gene_names.extend(names)
+
+        rq.put((num, gene_names))
+
+    except Exception, e:
+        rq.put((num, e))
+
+def _parse_parallel(filename, start, nsamples, procs):
+    """
+
+    Parse the rows of a ParseNormal-format file from byte offset start, using procs worker processes
+
+    The file is split into line-aligned byte ranges, and each worker parses its range directly into
+    a matrix in shared memory, at a column offset found from a raw line count of the preceding ranges
+
+    Returns (M, gene_names)
+
+    Throws an error naming the rows concerned if a worker dies without reporting back
+
+    """
+
+    ranges = _split_ranges(filename, start, procs)
+    counts = [ _count_lines(filename, a, b) for a, b in ranges ]
+    cols   = N.cumsum([0] + counts)
+    shape  = (nsamples, int(cols[-1]))
+
+    # Anonymous mmaps are shared with forked children
+    buf = mmap.mmap(-1, max(shape[0] * shape[1], 1) * N.dtype(N.float32).itemsize)
+    rq  = mp.Queue()
+
+    workers = {}
+    results = {}
+
+    try:
+        for i in xrange(len(ranges)):
+            workers[i] = mp.Process(target=_parse_range, args=(filename, ranges[i][0], ranges[i][1], nsamples, buf, shape, cols[i], rq, i))
+            workers[i].start()
+
+        # Collect results before joining, so a full queue can't block the workers
+        while len(results) < len(workers):
+            try:
+                num, result = rq.get(timeout=PARALLEL_POLL)
+            except Queue.Empty:
+                for i in workers:
+                    if i not in results and workers[i].exitcode:
+                        raise RuntimeError, 'Worker parsing data rows %s-%s (bytes %s-%s) of %s exited with code %s' % \
+                            (cols[i] + 1, cols[i + 1], ranges[i][0], ranges[i][1], filename, workers[i].exitcode)
+            else:
+                results[num] = result
+
+    finally:
+        for i in workers:
+            if workers[i].is_alive() and i not in results:
+                workers[i].terminate()
+            workers[i].join()
+
+    for i in xrange(len(ranges)):
+        if isinstance(results[i], Exception):
+            raise results[i]
+
+    M = N.frombuffer(buf, dtype=N.float32, count=shape[0] * shape[1]).reshape(shape)
+    gene_names = list(chain(*[ results[i] for i in xrange(len(ranges)) ]))
+
+    # Blank lines leave unused columns at the end of their ranges
+    if len(gene_names) < shape[1]:
+        used = N.concatenate([ N.arange(cols[i], cols[i] + len(results[i])) for i in xrange(len(ranges)) ])
+        M = M.take(used, 1)
+
+    return M, gene_names
+
+def _parse_rows(lines, nsamples):
+    """
+
+    Parse a list of ParseNormal-format data lines, skipping blank lines
+
+    Each line's fields are counted before parsing, so that a short line can't be made up by a long one.
+    All values in the block are then parsed by a single numpy call rather than per line or per field
+
+    Returns a (names, M) tuple, where M is a float32 array of shape (len(names), nsamples)
+
+    """
+
+    names  = []
+    values = []
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+
+        if line.strip():
+            name, _, rest = line.partition('\t')
+
+            found = rest and rest.count('\t') + 1 or 0
+            if found != nsamples:
+                raise ValueError, 'Wrong number of columns for %s: expected %s, found %s' % (name, nsamples, found)
+
+            names.append(name)
+            values.append(rest)
+
+    M = N.fromstring('\t'.join(values), dtype=N.float32, sep='\t')
+
+    if M.size != len(names) * nsamples:
+        for name, rest in zip(names, values):
+            if len(N.fromstring(rest, dtype=N.float32, sep='\t')) != nsamples:
+                raise ValueError, 'Unable to parse the values for %s' % name
+
+        raise ValueError, 'Unable to parse data block beginning with %s' % names[0]
+
+    return names, M.reshape(len(names), nsamples)
+
+def _iter_rows(handle, nsamples, chunksize=CHUNKSIZE):
+    """Yield (names, M) blocks of up to chunksize lines from the open file handle. See _parse_rows"""
+
+    while True:
+        lines = list(islice(handle, chunksize))
+
+        if not lines:
+            break
+
+        names, M = _parse_rows(lines, nsamples)
+
+        if names:
+            yield names, M
+
+def _drain(blocks):
+    """Iterate over blocks, releasing each item of a deque as it is consumed"""
+
+    if isinstance(blocks, deque):
+        while blocks:
+            yield blocks.popleft()
+    else:
+        for x in blocks:
+            yield x
+
+def read_normal_chunks(filename, chunksize=CHUNKSIZE):
+    """
+
+    read_normal_chunks(filename, chunksize)
+
+        Stream a tab-delimited file in the ParseNormal format without loading it whole.
+        Only chunksize rows are held in memory at any one time.
+
+    Returns: A generator of (gene_names, M) tuples, where gene_names is a list of the row labels in the block
+             and M is a float32 array of shape (len(gene_names), number of samples)
+
+    """
+
+    handle = ioutils.open_file(filename)
+    nsamples = len(handle.readline().strip('\n').split('\t')) - 1
+
+    try:
+        for block in _iter_rows(handle, nsamples, chunksize):
+            yield block
+    finally:
+        handle.close()
+
 
 class SampleData(object):
     """
@@ -113,9 +513,14 @@ class SampleData(object):
 
             cluster_id      - Id of cluster to which this sample belongs.  Generally assigned by clustering algorithms.
 
+        BaseParser objects keep their samples in a SampleTable, so this class is only needed to add
+        samples one at a time. Samples taken from a SampleTable are rows of it; see SampleTable.
+
 
     """
 
+    __slots__ = SAMPLE_FIELDS
+
     def __init__(self, sample_id=None, sample_num=None, sample_class=None, cluster_id=None, index=None):
 
         self.cluster_id = None
@@ -128,6 +533,233 @@ class SampleData(object):
 
         return self.sample_id[x]
 
+    def __getstate__(self):
+
+        return tuple([ getattr(self, k) for k in SAMPLE_FIELDS ])
+
+    def __setstate__(self, state):
+        """Older pickles hold the instance __dict__ rather than a tuple of fields"""
+
+        if isinstance(state, dict):
+            state = [ state.get(k) for k in SAMPLE_FIELDS ]
+
+        for k, v in izip(SAMPLE_FIELDS, state):
+            setattr(self, k, v)
+
+
+def _column(name):
+    """Property reading and writing one SampleTable column at a _SampleRow's position"""
+
+    def fget(self):
+        return getattr(self._table, name)[self._i]
+
+    def fset(self, value):
+        getattr(self._table, name)[self._i] = value
+        self._table._touch()
+
+    return property(fget, fset)
+
+class _SampleRow(SampleData):
+    """
+
+    A SampleData facade over row i of a SampleTable. Attribute changes are written to the table.
+    Copies and pickles are plain SampleData objects.
+
+    """
+
+    __slots__ = ('_table', '_i')
+
+    sample_id    = _column('sample_id')
+    sample_num   = _column('sample_num')
+    sample_class = _column('sample_class')
+    cluster_id   = _column('cluster_id')
+    index        = _column('index')
+
+    def __init__(self, table, i):
+
+        self._table = table
+        self._i     = i
+
+    def __reduce__(self):
+
+        return (SampleData, (), self.__getstate__())
+
+
+class SampleTable(object):
+    """
+
+    SampleTable
+
+        Sample metadata for a BaseParser object, stored as one list per SampleData attribute
+
+        Usage:
+
+            BaseParserObj.samples = SampleTable(sample_id, sample_num, sample_class, cluster_id, index)
+
+            Each argument is a sequence with one entry per sample. Any but sample_id may be left
+            as None, in which case that attribute is None for every sample.
+
+        The table behaves as a list of SampleData objects: it can be indexed, iterated, appended to,
+        extended and concatenated with + as before. Indexing and iterating return SampleData facades
+        over the rows, which are only valid until samples are added or removed.
+
+        Whole columns are available as the attributes of the same name, e.g. table.sample_id.
+        These are the stored lists themselves, so reassign rather than modify them if the
+        table is shared.
+
+        Every change made through the table or its rows bumps a version number, so that
+        name indexes built from it (see BaseParser._name_index) know to rebuild.
+
+    """
+
+    __slots__ = SAMPLE_FIELDS + ('_version',)
+
+    def __init__(self, sample_id=(), sample_num=None, sample_class=None, cluster_id=None, index=None):
+
+        self.sample_id = list(sample_id)
+
+        for k, v in izip(SAMPLE_FIELDS[1:], (sample_num, sample_class, cluster_id, index)):
+            if v is None:
+                v = [None] * len(self.sample_id)
+            elif len(v) != len(self.sample_id):
+                raise ValueError, 'Column %s has %s entries, expected %s' % (k, len(v), len(self.sample_id))
+
+            setattr(self, k, list(v))
+
+    @classmethod
+    def from_samples(cls, samples):
+        """Build a SampleTable from a sequence of SampleData objects, or copy another SampleTable"""
+
+        if isinstance(samples, SampleTable):
+            return samples.copy()
+
+        samples = list(samples)
+        c = cls.__new__(cls)
+
+        for k in SAMPLE_FIELDS:
+            setattr(c, k, [ getattr(x, k) for x in samples ])
+
+        return c
+
+    def __setattr__(self, k, v):
+
+        object.__setattr__(self, k, v)
+
+        if k != '_version':
+            self._touch()
+
+    def _touch(self):
+
+        object.__setattr__(self, '_version', getattr(self, '_version', 0) + 1)
+
+    def _columns(self):
+
+        return [ getattr(self, k) for k in SAMPLE_FIELDS ]
+
+    def copy(self):
+
+        return self.take(slice(None))
+
+    def take(self, indices):
+        """Return a new SampleTable holding the rows in indices (a sequence or a slice), in that order"""
+
+        c = SampleTable.__new__(SampleTable)
+
+        if isinstance(indices, slice):
+            for k in SAMPLE_FIELDS:
+                setattr(c, k, getattr(self, k)[indices])
+        else:
+            for k in SAMPLE_FIELDS:
+                col = getattr(self, k)
+                setattr(c, k, [ col[i] for i in indices ])
+
+        return c
+
+    def append(self, sample):
+
+        for col, k in izip(self._columns(), SAMPLE_FIELDS):
+            col.append(getattr(sample, k))
+
+        self._touch()
+
+    def extend(self, samples):
+
+        if not isinstance(samples, SampleTable):
+            samples = SampleTable.from_samples(samples)
+
+        for k in SAMPLE_FIELDS:
+            getattr(self, k).extend(getattr(samples, k))
+
+        self._touch()
+
+    def __add__(self, x):
+
+        c = self.copy()
+        c.extend(x)
+
+        return c
+
+    def __radd__(self, x):
+
+        c = SampleTable.from_samples(x)
+        c.extend(self)
+
+        return c
+
+    def __len__(self):
+
+        return len(self.sample_id)
+
+    def _row(self, i):
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError, 'sample index out of range'
+
+        return _SampleRow(self, i)
+
+    def __getitem__(self, x):
+
+        if isinstance(x, slice):
+            return self.take(x)
+        return self._row(x)
+
+    def __setitem__(self, x, sample):
+
+        row = self._row(x)
+
+        for k in SAMPLE_FIELDS:
+            setattr(row, k, getattr(sample, k))
+
+    def __delitem__(self, x):
+
+        for col in self._columns():
+            del col[x]
+
+        self._touch()
+
+    def __iter__(self):
+
+        for i in xrange(len(self)):
+            yield _SampleRow(self, i)
+
+    def __getstate__(self):
+
+        return self._columns()
+
+    def __setstate__(self, state):
+
+        if isinstance(state, dict):
+            state = [ state.get(k) for k in SAMPLE_FIELDS ]
+
+        for k, v in izip(SAMPLE_FIELDS, state):
+            setattr(self, k, v)
+
+    def __repr__(self):
+
+        return 'SampleTable(%s)' % ', '.join([ '%s=%r' % (k, getattr(self, k)) for k in SAMPLE_FIELDS ])
+
 
 class BaseParser(object):
     """
@@ -139,7 +771,7 @@ class BaseParser(object):
         
         1: Have an __init__ method which takes data_file as an argument
 
-        2: Have a _parse_data_file method which adds SampleData objects to self.samples
+        2: Have a _parse_data_file method which sets self.samples to a SampleTable, or adds SampleData objects to it
 
         3: If the data vector entries have labels (e.g., gene probe names), they should be assigned
            to self.gene_names as a list, in the same length and order as the data vectors in each sample
@@ -149,14 +781,15 @@ class BaseParser(object):
 
         Properties
 
-            samples     - A list of SampleData objects
+            samples     - A SampleTable, which behaves as a list of SampleData objects.
+                          Lists of SampleData objects assigned to it are converted
             gene_names  - A list of data vector entry labels
 
     """
 
     def __init__(self, data_file):
 
-        self.samples = []  #List of SampleData instances
+        self.samples = SampleTable()
         self.gene_names = []
 
         self._parse_data_file(data_file)
@@ -218,7 +851,7 @@ class BaseParser(object):
 
         return self.merge(x)
 
-    def get_samples(self, *filenames):
+    def get_samples(self, *filenames, **kwds):
         """
         
         Extract a new BaseParser object from samples in *filenames
@@ -231,12 +864,18 @@ class BaseParser(object):
 
         The new BaseParser object will be reduced to the sample set in *filenames.
 
+        If the keyword view is True, a ParserView is returned instead, which copies nothing until used.
+
         """
 
         sample_defs    = ioutils.list_or_files(*filenames)
+        sample_indices = tuple(ioutils.index_intersect(self.sample_index, list(chain(*sample_defs.values()))))
+        view           = kwds.get('view', False)
 
         # The list of samples is a special case, and we shouldn't mangle sample_classes in that case
         if sample_defs.keys() == [None]:
+            if view:
+                return ParserView(self, rows=sample_indices)
             d = self.class_dict
         else:
             d = sample_defs
@@ -244,20 +883,21 @@ class BaseParser(object):
         class_dict = dict([ (d[k][i], k) for k in d
                             for i in xrange(len(d[k])) ])
 
-        sample_indices = tuple(ioutils.argintersect(self.sample_ids, sum(sample_defs.values(), [])))
+        if view:
+            sample_ids = self.sample_ids
+            return ParserView(self, rows=sample_indices, classes=[ class_dict[sample_ids[i]] for i in sample_indices ])
 
         c = NullParser()
 
-        c.samples = [ SampleData(cluster_id=self.samples[i].cluster_id, sample_id=self.samples[i].sample_id,
-                                 sample_num=self.samples[i].sample_num, index=self.samples[i].index,
-                                 sample_class=class_dict[self.samples[i].sample_id]) for i in sample_indices ]
+        c.samples = self.samples.take(sample_indices)
+        c.samples.sample_class = [ class_dict[x] for x in c.samples.sample_id ]
 
         c.M = self.M.take(sample_indices, 0)
         c.gene_names = self.gene_names.copy()
 
         return c
 
-    def get_features(self, *filenames):
+    def get_features(self, *filenames, **kwds):
         """
 
         Extract a new BaseParser object from features in *filenames
@@ -267,18 +907,21 @@ class BaseParser(object):
 
         The new BaseParser object will be reduced to the feature set in *filenames.
 
+        If the keyword view is True, a ParserView is returned instead, which copies nothing until used.
+
         """
 
-        plist = sum(ioutils.list_or_files(*filenames).values(), [])
-        pinds = tuple(ioutils.argintersect(self.gene_names, plist))
+        plist = list(chain(*ioutils.list_or_files(*filenames).values()))
+        pinds = tuple(ioutils.index_intersect(self.gene_index, plist))
+
+        if kwds.get('view', False):
+            return ParserView(self, cols=pinds)
 
         c = NullParser()
 
         c.M = self.M.take(pinds, 1)
         c.gene_names = self.gene_names.take(pinds)
-        c.samples = [ SampleData(cluster_id=x.cluster_id, sample_id=x.sample_id,
-                                 sample_num=x.sample_num, index=x.index,
-                                 sample_class=x.sample_class) for x in self.samples ]
+        c.samples = self.samples.copy()
 
         return c
 
@@ -288,13 +931,11 @@ class BaseParser(object):
         # We can't use argintersect because of the uniqueness constraint
         if cls in self.sample_classes:
 
-            sample_indices = tuple([ i for i in xrange(len(self)) if self.samples[i].sample_class == cls ])
+            sample_indices = tuple([ i for i, x in enumerate(self.samples.sample_class) if x == cls ])
 
             c = NullParser()
 
-            c.samples = [ SampleData(cluster_id=self.samples[i].cluster_id, sample_id=self.samples[i].sample_id,
-                                     sample_num=self.samples[i].sample_num, index=self.samples[i].index,
-                                     sample_class=cls) for i in sample_indices ]
+            c.samples = self.samples.take(sample_indices)
 
             c.M = self.M.take(sample_indices, 0)
             c.gene_names = self.gene_names.copy()
@@ -303,57 +944,101 @@ class BaseParser(object):
 
         raise ValueError, '%s not found in dataset' % (cls)
 
-    def merge(self, x):
-        """Merge two BaseParser objects. The feature set is reduced to the most common set, and samples are appended."""
+    def merge(self, *x):
+        """
+        Merge BaseParser objects. The feature set is reduced to the most common set, and samples are appended.
+        Any number of objects may be given; see merge_all.
+        
+        """
 
-        x_sids = dict.fromkeys(x.sample_ids)
+        return merge_all((self,) + x)
 
-        for sid in self.sample_ids:
-            if sid in x_sids:
-                raise ValueError, 'One or more sample ids are not unique, unable to concatenate'
+    @property
+    def samples(self):
 
-        if len(self.gene_names) and len(x.gene_names):
-            fst = ioutils.argintersect(self.gene_names, x.gene_names)
-            snd = ioutils.argintersect(x.gene_names, self.gene_names)
+        return self._samples
 
-            if not len(fst):
-                raise ValueError, "No matching gene names in either set! Cannot concatenate."
+    @samples.setter
+    def samples(self, value):
 
-            gene_names = self.gene_names.take(tuple(fst))
-            
-            M = self.M.take(fst, 1) #Memory-intensive but we certainly don't want to
-            Q = x.M.take(snd, 1)    #change the objects themselves
+        if not isinstance(value, SampleTable):
+            value = SampleTable.from_samples(value)
 
-        else:
-            print('WARNING: Concatenating one or more sets without a gene list! Do so at your own risk!')
+        self._samples = value
 
-        c = NullParser()
+    def _name_index(self, key, obj, names):
+        """
 
-        c.gene_names = gene_names
-        c.samples = self.samples + x.samples
-        c.M = N.vstack((M, Q))
+        Returns a dict of name -> position for the names in obj, where names is a function returning them.
+        The dict is cached under key until obj is replaced, changes length or, for a SampleTable, is changed
+        at all. In-place replacement of single gene names is not detected, so reassign gene_names instead.
 
-        return c
+        """
+
+        cached = self.__dict__.get(key)
+        stamp  = (len(obj), getattr(obj, '_version', None))
+
+        if cached is not None and cached[0] is obj and cached[1] == stamp:
+            return cached[2]
+
+        nlist = names()
+        index = dict(izip(nlist, xrange(len(nlist))))
+
+        if len(index) != len(nlist):
+            raise ValueError, 'One or more sets contain non-unique elements'
+
+        self.__dict__[key] = (obj, stamp, index)
+
+        return index
+
+    @property
+    def gene_index(self):
+        """Returns a dict of gene_names -> column of M. See _name_index"""
+
+        return self._name_index('_gene_index', self.gene_names, lambda: list(self.gene_names))
+
+    @property
+    def sample_index(self):
+        """Returns a dict of sample_ids -> row of M. See _name_index"""
+
+        return self._name_index('_sample_index', self.samples, lambda: self.sample_ids)
+
+    def __getstate__(self):
+        """Leave the name indices out of pickles; they are rebuilt on demand"""
+
+        state = self.__dict__.copy()
+        state.pop('_gene_index', None)
+        state.pop('_sample_index', None)
+
+        return state
+
+    def __setstate__(self, state):
+        """Older pickles hold samples as a list of SampleData objects"""
+
+        if 'samples' in state:
+            state['_samples'] = SampleTable.from_samples(state.pop('samples'))
+
+        self.__dict__.update(state)
 
     @property
     def sample_ids(self):
-        """Returns a list of sample_ids from self.samples"""
+        """Returns the list of sample_ids in self.samples. This is the stored column, so don't modify it"""
 
-        return [ x.sample_id for x in self.samples ]
+        return self.samples.sample_id
 
     @property
     def sample_classes(self):
         """Returns a sorted list of sample_classes from self.samples"""
 
-        return list(set([ x.sample_class for x in self.samples ]))
+        return list(set(self.samples.sample_class))
     
     @property
     def class_dict(self):
         """Returns a dict with sample_classes as keys and the representative sample_ids as values"""
 
         cd = {}
-        for sam in self.samples:
-            cd.setdefault(sam.sample_class, []).append(sam.sample_id)
+        for cls, sid in izip(self.samples.sample_class, self.samples.sample_id):
+            cd.setdefault(cls, []).append(sid)
         return cd
 
 class NullParser(BaseParser):
@@ -367,6 +1052,261 @@ class NullParser(BaseParser):
         pass
 
 
+def _gene_positions(names, gene_names):
+    """
+
+    Returns (found, pos), where found is a boolean array marking the elements of names also in gene_names,
+    and pos holds their positions in gene_names (meaningless where found is False)
+
+    Throws an error if gene_names is not unique
+
+    """
+
+    gene_names = N.asarray(gene_names)
+
+    order  = gene_names.argsort(kind='mergesort')
+    sgenes = gene_names.take(order)
+
+    if (sgenes[1:] == sgenes[:-1]).any():
+        raise ValueError, 'One or more sets contain non-unique elements'
+
+    if not len(sgenes):
+        return N.zeros(len(names), dtype=bool), N.zeros(len(names), dtype=int)
+
+    pos = sgenes.searchsorted(names).clip(0, len(sgenes) - 1)
+
+    return sgenes.take(pos) == names, order.take(pos)
+
+def merge_all(sdatas):
+    """
+
+    Merge a sequence of BaseParser objects, e.g. a cohort parsed from many per-batch files.
+    The feature set is reduced to the features found in all of them, in the order of the first, and the samples
+    are appended in order.
+
+    Gives the same result as merging them two at a time, but the shared features and sample layout are worked
+    out once and each input matrix is copied exactly once, straight into the preallocated result.
+
+    Throws an error if sample ids are repeated, or if no features are shared
+
+    """
+
+    sdatas = list(sdatas)
+
+    if not sdatas:
+        raise ValueError, 'No datasets to merge'
+
+    samples = SampleTable()
+    for x in sdatas:
+        samples.extend(x.samples)
+
+    if len(set(samples.sample_id)) != len(samples):
+        raise ValueError, 'One or more sample ids are not unique, unable to concatenate'
+
+    if all([ len(x.gene_names) for x in sdatas ]):
+        gene_names = N.asarray(sdatas[0].gene_names)
+        common     = N.ones(len(gene_names), dtype=bool)
+        positions  = [ None ]
+
+        # Columns of each set in the order of the first, so features line up even if the sets are ordered differently
+        for x in sdatas[1:]:
+            found, pos = _gene_positions(gene_names, x.gene_names)
+            common &= found
+            positions.append(pos)
+
+        if not common.any():
+            raise ValueError, "No matching gene names in either set! Cannot concatenate."
+
+        gene_names = gene_names.compress(common)
+        cols = [ N.flatnonzero(common) ] + [ pos.compress(common) for pos in positions[1:] ]
+
+    else:
+        print('WARNING: Concatenating one or more sets without a gene list! Do so at your own risk!')
+
+        if len(set([ x.M.shape[1] for x in sdatas ])) != 1:
+            raise ValueError, 'Datasets without gene lists must have the same number of features'
+
+        named = [ x.gene_names for x in sdatas if len(x.gene_names) ]
+        if named:
+            gene_names = N.asarray(named[0])
+        else:
+            gene_names = []
+        cols = [ N.arange(sdatas[0].M.shape[1]) ] * len(sdatas)
+
+    M = N.empty((len(samples), len(cols[0])), dtype=N.result_type(*[ x.M.dtype for x in sdatas ]))
+
+    r = 0
+    for x, col in izip(sdatas, cols):
+        n = len(x)
+
+        if len(col) == x.M.shape[1] and (col == N.arange(len(col))).all():
+            M[r:r + n] = x.M
+        elif x.M.dtype == M.dtype:
+            N.take(x.M, col, 1, out=M[r:r + n], mode='clip')
+        else:
+            M[r:r + n] = x.M.take(col, 1)
+
+        r += n
+
+    c = NullParser()
+
+    c.gene_names = gene_names
+    c.samples = samples
+    c.M = M
+
+    return c
+
+
+class ParserView(BaseParser):
+    """
+
+    ParserView
+
+        A subset of the rows (samples) and columns (features) of another BaseParser object, returned by
+        get_samples and get_features when called with view=True.
+
+        Only the index arrays are stored. M, gene_names and samples are built from the parent the first
+        time they are used, with M taken in a single copy however many views were chained to build it.
+        Changes to the parent are seen by the view until then.
+
+        get_samples and get_features on a view return further views by default.
+
+        Properties
+
+            parent      - The BaseParser object the indices refer to
+            rows        - Indices of the samples in parent, or None for all of them
+            cols        - Indices of the features in parent, or None for all of them
+
+    """
+
+    def __init__(self, parent, rows=None, cols=None, classes=None):
+
+        # Chained views all refer back to the original parser
+        if isinstance(parent, ParserView):
+            if rows is None:
+                rows, classes = parent.rows, parent._classes
+            else:
+                if classes is None and parent._classes is not None:
+                    classes = [ parent._classes[i] for i in rows ]
+                if parent.rows is not None:
+                    rows = parent.rows.take(rows)
+
+            if cols is not None and parent.cols is not None:
+                cols = parent.cols.take(cols)
+            elif cols is None:
+                cols = parent.cols
+
+            parent = parent.parent
+
+        if rows is not None:
+            rows = N.asarray(rows, dtype=int)
+        if cols is not None:
+            cols = N.asarray(cols, dtype=int)
+
+        self.parent = parent
+        self.rows   = rows
+        self.cols   = cols
+
+        self._classes = classes
+
+    @property
+    def M(self):
+
+        if '_M' not in self.__dict__:
+            M = self.parent.M
+
+            if self.rows is not None and self.cols is not None:
+                M = M[N.ix_(self.rows, self.cols)]
+            elif self.rows is not None:
+                M = M.take(self.rows, 0)
+            elif self.cols is not None:
+                M = M.take(self.cols, 1)
+            else:
+                M = M.copy()
+
+            self._M = M
+
+        return self._M
+
+    @M.setter
+    def M(self, value):
+
+        self._M = value
+
+    def __array__(self, dtype=None):
+
+        if dtype is None:
+            return self.M
+        return self.M.astype(dtype)
+
+    @property
+    def gene_names(self):
+
+        if '_gene_names' not in self.__dict__:
+            if self.cols is not None:
+                self._gene_names = N.asarray(self.parent.gene_names).take(self.cols)
+            else:
+                self._gene_names = N.array(self.parent.gene_names)
+
+        return self._gene_names
+
+    @gene_names.setter
+    def gene_names(self, value):
+
+        self._gene_names = value
+
+    @property
+    def samples(self):
+
+        if '_samples' not in self.__dict__:
+            if self.rows is None:
+                self._samples = self.parent.samples.copy()
+            else:
+                self._samples = self.parent.samples.take(self.rows)
+
+            if self._classes is not None:
+                self._samples.sample_class = list(self._classes)
+
+        return self._samples
+
+    @samples.setter
+    def samples(self, value):
+
+        BaseParser.samples.fset(self, value)
+
+    @property
+    def sample_ids(self):
+
+        if '_samples' in self.__dict__ or self.rows is None:
+            return BaseParser.sample_ids.fget(self)
+
+        sample_ids = self.parent.sample_ids
+        return [ sample_ids[i] for i in self.rows ]
+
+    @property
+    def sample_index(self):
+
+        if '_samples' in self.__dict__ or self.rows is None:
+            return BaseParser.sample_index.fget(self)
+        return self._name_index('_sample_index', self.rows, lambda: self.sample_ids)
+
+    def __len__(self):
+
+        if '_samples' in self.__dict__ or self.rows is None:
+            return len(self.samples)
+        return len(self.rows)
+
+    def get_samples(self, *filenames, **kwds):
+
+        kwds.setdefault('view', True)
+        return BaseParser.get_samples(self, *filenames, **kwds)
+
+    def get_features(self, *filenames, **kwds):
+
+        kwds.setdefault('view', True)
+        return BaseParser.get_features(self, *filenames, **kwds)
+
+
 class ParseNormal(BaseParser):
     """
 
@@ -375,28 +1315,94 @@ class ParseNormal(BaseParser):
         This is the one you use when the data is just a table with no special characteristics
         Probes in rows, samples in columns.  Sample ids are in row 0, and gene ids
         are in column 0.
+
+        If cache is True, the parsed data is written to a binary sidecar (data_file + SIDECAR_EXTENSION)
+        which is memory-mapped on later loads, for as long as data_file is unchanged.
+
+        If procs is greater than 1, uncompressed files of at least PARALLEL_MIN_BYTES are parsed
+        by that many processes at once.
         
     """
 
-    def __init__(self, data_file):
+    def __init__(self, data_file, cache=USE_SIDECAR, procs=1):
+
+        self.cache = cache
+        self.procs = procs
 
         BaseParser.__init__(self, data_file)
 
     def _parse_data_file(self, data_file):
         """Parse datafile into sample name<->number pairs and load probe data"""
 
-        sample_list = open(data_file, 'r').readline().strip('\n').split('\t')
+        if self.cache:
+            cached = _read_sidecar(data_file)
+
+            if cached is not None:
+                self.M, meta = cached
+                self.gene_names = meta['gene_names']
+                self.samples = SampleTable(meta['sample_ids'])
+                return
 
-        for sam_id in sample_list[1:]:
-            self.samples.append(SampleData(sample_id=sam_id))
+        self._parse_text_file(data_file)
 
-        self.gene_names = N.loadtxt(data_file, delimiter='\t', skiprows=1, usecols=[0], dtype='S')
+        if self.cache:
+            _write_sidecar(self, data_file)
 
-        self.M = N.loadtxt(data_file, delimiter='\t', skiprows=1, usecols=xrange(1, len(sample_list)), dtype=N.float32).T
+    def _parse_text_file(self, data_file):
+        """
 
-        # Fixes 1-sample bug
-        if len(self.M.shape) == 1:
-            self.M = self.M.reshape(1, self.M.shape[0])
+        Parse a tab-delimited text file in a single parsing pass
+
+        The file is read in blocks of rows, each of which is parsed at once and copied into a
+        preallocated float32 matrix, already laid out samples by genes. For uncompressed files the
+        matrix is sized by a raw newline count first, see _count_lines
+
+        gzip and bz2 files are decompressed as they are read. See ioutils.open_file
+
+        """
+
+        handle = ioutils.open_file(data_file)
+        sample_list = handle.readline().strip('\n').split('\t')
+
+        self.samples = SampleTable(sample_list[1:])
+
+        nsamples = len(sample_list) - 1
+        blocks   = _iter_rows(handle, nsamples)
+
+        if self.procs > 1 and isinstance(handle, file) and os.path.getsize(data_file) >= PARALLEL_MIN_BYTES:
+            start = handle.tell()
+            handle.close()
+
+            self.M, gene_names = _parse_parallel(data_file, start, nsamples, self.procs)
+            self.gene_names = N.array(gene_names, dtype='S')
+            self._check_unique()
+            return
+
+        if ioutils.compression(data_file) is None:
+            # Upper bound on the number of rows, which may include blank lines
+            nrows = max(_count_lines(data_file) - 1, 0)
+        else:
+            # Counting rows would mean decompressing twice, so keep the parsed blocks instead.
+            # They are released as they are copied, and the untouched matrix pages cost nothing until then
+            blocks = deque(blocks)
+            nrows  = sum([ len(x[0]) for x in blocks ])
+
+        self.M = N.empty((nsamples, nrows), dtype=N.float32)
+        gene_names = []
+
+        for names, M in _drain(blocks):
+            self.M[:, len(gene_names):len(gene_names) + len(names)] = M.T
+            gene_names.extend(names)
+
+        handle.close()
+
+        if len(gene_names) < nrows:
+            self.M = self.M[:, :len(gene_names)].copy()
+
+        self.gene_names = N.array(gene_names, dtype='S')
+        self._check_unique()
+
+    def _check_unique(self):
 
         try:
             assert len(set(self.sample_ids)) == len(self)
@@ -407,3 +1413,68 @@ class ParseNormal(BaseParser):
             assert len(set(self.gene_names)) == len(self.gene_names)
         except:
             raise ValueError, 'One or more features in this file are not unique!'
+
+
+class ParseEdges(BaseParser):
+    """
+
+    ParseEdges
+
+        Opens a sparse network written by writeutils.write_edges as a symmetric matrix, with a sample and a gene
+        for each node and M[i][j] = M[j][i] the weight of the edge between nodes i and j, or 1 if it has none.
+
+        If categories is given, only edges in those categories are used.
+
+    """
+
+    def __init__(self, data_file, categories=None):
+
+        self.categories = categories
+
+        BaseParser.__init__(self, data_file)
+
+    def _parse_data_file(self, data_file):
+        """Load labels and fill in the matrix from the edge list"""
+
+        names, I, J, W, categories = read_edges(data_file)
+
+        if self.categories:
+            keep = N.in1d(categories, list(self.categories))
+            I, J, W = I[keep], J[keep], W[keep]
+
+        W = N.where(N.isnan(W), 1, W)
+
+        self.M = N.zeros((len(names), len(names)), dtype=N.float32)
+        self.M[I, J] = W
+        self.M[J, I] = W
+
+        self.gene_names = names
+        self.samples = SampleTable(names)
+
+
+class ParseNative(BaseParser):
+    """
+
+    ParseNative
+
+        Opens a binary file written by writeutils.write_native (or a ParseNormal sidecar).
+        The data matrix is memory-mapped rather than read, so opening is nearly instant regardless of size,
+        and many processes opening the same file share a single copy in memory.
+
+        mmap_mode is 'r' (read-only, the default), 'c' (copy-on-write), or None to read the matrix into memory.
+        
+    """
+
+    def __init__(self, data_file, mmap_mode='r'):
+
+        self.mmap_mode = mmap_mode
+
+        BaseParser.__init__(self, data_file)
+
+    def _parse_data_file(self, data_file):
+        """Map the data matrix and load labels"""
+
+        self.M, meta = read_native(data_file, self.mmap_mode)
+        self.gene_names = meta['gene_names']
+
+        self.samples = SampleTable(meta['sample_ids'])
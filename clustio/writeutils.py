@@ -24,18 +24,36 @@ along with ConsensusCluster.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-def write_normal(sdata, filename):
+import numpy   as N
+import cPickle as cp
+
+WRITE_BLOCKSIZE = 1 << 20  # Approximate number of matrix values formatted at once by write_normal
+
+def write_normal(sdata, filename, fmt=None):
     """
 
     Takes an sdata obj and writes out a tab-delimited datafile, suitable for ParseNormal
     useful to convert between data formats, writing PCA-selected data, etc
 
+    fmt is an optional %-style format for the values, e.g. '%.6g'. By default values are written
+    exactly as str() would write each numpy scalar.
+
+    Genes are formatted and written a block at a time rather than line by line.
+
     """
     
     if not len(sdata.gene_names) > 0: 
         raise ValueError, "No gene names found! Unsuitable for this data format."
 
-    sids = [x.sample_id for x in sdata.samples]
+    sids = sdata.sample_ids
+
+    nsamples = len(sids)
+    ngenes   = len(sdata.gene_names)
+    step     = max(1, WRITE_BLOCKSIZE // max(nsamples, 1))
+    sep      = nsamples and "\t" or ""
+
+    if fmt is not None:
+        rowfmt = "\t".join([fmt] * nsamples)
 
     f = open(filename, 'w')
 
@@ -43,11 +61,65 @@ def write_normal(sdata, filename):
     f.write("\t".join(['SAMPLE ID'] + sids))
     f.write("\n")
 
-    #Data
-    for i in xrange(len(sdata.gene_names)):
-        f.write("\t".join([sdata.gene_names[i]] + [ str(sdata.M[j][i]) for j in xrange(len(sdata.samples)) ]))
-        f.write("\n")
+    #Data, one block of genes (columns of M) at a time
+    for i in xrange(0, ngenes, step):
+        names = list(sdata.gene_names[i:i + step])
+        block = N.asarray(sdata.M[:nsamples, i:i + step]).T
+
+        if fmt is None:
+            rows = [ "\t".join(x) for x in block.astype(str).tolist() ]
+        else:
+            rows = [ rowfmt % tuple(x) for x in block.tolist() ]
+
+        f.write("".join([ "".join([names[k], sep, rows[k], "\n"]) for k in xrange(len(names)) ]))
+
+    f.close()
+
+def write_native(sdata, filename, **meta):
+    """
+
+    Takes an sdata obj and writes out a binary file, suitable for ParseNative
+
+    The file is an .npy block holding sdata.M, followed by a pickled dict of gene_names, sample_ids
+    and any extra keywords given. Because the matrix comes first at a fixed offset, it can be
+    memory-mapped directly without reading the file.
+
+    """
+
+    meta.update({'gene_names': N.asarray(sdata.gene_names), 'sample_ids': list(sdata.sample_ids)})
+
+    f = open(filename, 'wb')
+    N.lib.format.write_array(f, N.asarray(sdata.M))
+    cp.dump(meta, f, cp.HIGHEST_PROTOCOL)
+    f.close()
+
+def write_edges(names, I, J, weights, filename, categories=None):
+    """
+
+    Writes a sparse network as an .npz edge list, suitable for parsers.read_edges and ParseEdges.
+    Its size grows with the number of edges rather than the square of the number of nodes.
+
+    names is the node label table, and edge k joins nodes I[k] and J[k] with weight weights[k], NaN if it has none.
+    categories, such as VisML method ids, may be a single string or an array aligned to I and J.
+    Each distinct category is stored once, with a small integer code for each edge.
+
+    """
+
+    I, J = N.asarray(I), N.asarray(J)
+
+    if categories is None:
+        categories = ''
+
+    if isinstance(categories, basestring):
+        table, codes = N.array([categories]), N.zeros(len(I), dtype=int)
+    else:
+        table, codes = N.unique(N.asarray(categories), return_inverse=True)
+
+    index = N.min_scalar_type(max(len(names) - 1, 0))
 
+    f = open(filename, 'wb')
+    N.savez_compressed(f, names=N.asarray(names), i=I.astype(index), j=J.astype(index), weight=N.asarray(weights),
+                       categories=table, category=codes.astype(N.min_scalar_type(max(len(table) - 1, 0))))
     f.close()
 
 def write_table(ndict, filename):
@@ -25,23 +25,31 @@ import sys, auc, auc_perm, scripts, clustio, treeio, getopt, random, os
 
 import numpy   as N
 import cPickle as cp
+import multiprocessing as mp
 
 from pyvisml import VisML
 from random import sample
 from itertools import combinations as comb
+from itertools import izip
 
 
 ITER_ENH  = 5000  # Number of permutations to run for enhancement calculation. Note that higher numbers will vastly increase processing time.
 ITER_PERM = 5000  # Number of permutations to run for significance calculation
 ITER_ENH_T= 1000 # Number of permutations to run to find a minimum threshold for calculating enhancement for that size pair
 
+PRESENCE_THRESHOLD = 1.0  # Expression value at or above which a gene is considered present in a sample
+PRESENCE_FRACTION  = 0.85 # Fraction of samples in which a gene must be present to be considered present in the condition
+
+SA_FILE      = 'gene_presence/%s_top85_gt_1.npz' # Packed gene presence definitions for a condition, see write_sa
+SA_TEXT_FILE = 'gene_presence/%s_top85_gt_1.txt' # Older tab-delimited gene presence definitions, converted by get_sa
+
 
 def _calculate_perm_test(fn, fln):
     # OLD METHOD, SUPERCEDED ON JULY 29 2014
 
     # TODO Hide output
     
-    sa = get_sa(fn)
+    sa = get_sa(fn, fln.gene_names)
     results = []                                                                 
     for i in xrange(ITER_PERM):
         p1 = sample(fln.gene_names, 4)
@@ -54,24 +62,76 @@ def _calculate_sig_connections(fn):
     # OLD METHOD, SUPERCEDED ON JULY 29 2014
 
     s = clustio.ParseNormal('auc_results/%s_results_reweight_RAW.txt' % fn)
-    for i, j in comb(xrange(len(s)), 2):
-        v = N.sqrt(s.M[i][j] * s.M[j][i])
-        s.M[i][j] = s.M[j][i] = v
+    mutualize(s)
     results = [ float(x) for x in clustio.read_list('auc_results/%s_perm_test_4_500.txt' % fn) ]
     results.sort()
     t95 = results[int(0.95 * ITER_PERM)]
-    for i, j in comb(xrange(len(s)), 2):
-        if s.M[i][j] < t95:
-            s.M[i][j] = s.M[j][i] = 0
+    auc.mask_matrix(s.M, t95, inclusive=False)
     clustio.write_normal(s, 'sig_connections/%s_sig_connections_999.txt' % fn)
 
 
-def get_sa(fn):
+def get_sa(fn, gene_names):
+    """
+    Returns the gene presence definitions for condition fn as a boolean masked array aligned to gene_names,
+    usually fln.gene_names. Genes without a definition are masked, and auc.roc refuses them as targets.
+
+    Older text definitions are converted to the packed format the first time they are read
+
+    """
+
+    if not os.path.exists(SA_FILE % fn):
+        convert_sa(fn)
+
+    names, present = read_sa(SA_FILE % fn)
+
+    if N.array_equal(names, gene_names):
+        return N.ma.array(present)
+
+    return align_sa(names, present, gene_names)
+
+def align_sa(gene_names, present, order):
+    """Reorders the presence array for gene_names to the genes in order, as a masked array where genes not in gene_names are masked"""
+
+    idx = dict(izip(gene_names, xrange(len(gene_names))))
+    pos = N.array([ idx.get(x, -1) for x in order ], dtype=int)
+
+    found = pos >= 0
+    res   = N.zeros(len(pos), dtype=bool)
+    res[found] = present[pos[found]]
+
+    return N.ma.array(res, mask=~found)
+
+def read_sa(filename):
+    """Reads a file written by save_sa. Returns a (gene_names, present) tuple"""
+
+    f = N.load(filename)
+
+    try:
+        gene_names = f['gene_names']
+        present    = N.unpackbits(f['presence'])[:int(f['ngenes'])].astype(bool)
+    finally:
+        f.close()
+
+    return gene_names, present
+
+def save_sa(gene_names, present, filename):
+    """Writes gene_names and the boolean array present, packed eight genes to a byte, to an .npz file"""
+
+    f = open(filename, 'wb')
+    N.savez(f, gene_names=N.asarray(gene_names), presence=N.packbits(present), ngenes=len(present))
+    f.close()
+
+def convert_sa(fn):
+    """Converts the tab-delimited gene presence definitions for condition fn to the packed format"""
+
+    handle = clustio.open_file(SA_TEXT_FILE % fn)
+    lines  = [ x.rsplit('\t', 1) for x in handle.read().splitlines() if x ]
+    handle.close()
 
-    sa = clustio.read_table('gene_presence/%s_top85_gt_1.txt' % fn)                
-    for x in sa:                    
-        sa[x] = int(sa[x])                          
-    return sa
+    gene_names = [ x[0] for x in lines ]
+    present    = N.array([ int(x[1]) for x in lines ], dtype=int) != 0
+
+    save_sa(gene_names, present, SA_FILE % fn)
 
 def create_new_symm_dset(features):
 
@@ -80,15 +140,13 @@ def create_new_symm_dset(features):
 
     c = clustio.parsers.NullParser()                                             
     c.gene_names = N.array(features)       
-    c.samples = [ clustio.parsers.SampleData(sample_id=x) for x in c.gene_names ] 
+    c.samples = clustio.parsers.SampleTable(c.gene_names)
 
     return c
 
 def mutualize(s):
 
-    for i, j in comb(xrange(len(s)), 2):
-        v = N.sqrt(s.M[i][j] * s.M[j][i])
-        s.M[i][j] = s.M[j][i] = v
+    s.M = auc.mutual_matrix(s.M)
 
 def calculate_overlaps(pathway_dict):
 
@@ -101,16 +159,56 @@ def calculate_overlaps(pathway_dict):
 
     return list(set(overlaps))
 
-def calculate_sa(s, fn):
+def write_sa(gene_names, counts, nsamples, fn, fraction=PRESENCE_FRACTION, order=None):
+    """
+    Writes the presence definitions for condition fn, where counts[i] is the number of the nsamples samples
+    in which gene_names[i] is present, to SA_FILE.
+
+    If order is given, usually fln.gene_names, the definitions are stored in that gene order so get_sa
+    has nothing to realign. Genes in order but not in gene_names are left out, so they stay undefined.
+
+    """
+
+    present = N.asarray(counts) >= nsamples * fraction
+
+    if order is not None:
+        names = set(gene_names)
+        order = [ x for x in order if x in names ]
+
+        present    = align_sa(gene_names, present, order).filled(False)
+        gene_names = order
 
-    M = (s.M >= 1.0).sum(0)
-    thresh = len(s) * 0.85
-    nd = dict([ (s.gene_names[i], int(M[i] >= thresh)) for i in xrange(len(s.gene_names)) ])
-    clustio.write_table(nd, 'gene_presence/%s_top85_gt_1.txt' % fn)
+    save_sa(gene_names, present, SA_FILE % fn)
+
+def calculate_sa(s, fn, threshold=PRESENCE_THRESHOLD, fraction=PRESENCE_FRACTION, order=None):
+
+    M = (s.M >= threshold).sum(0)
+    write_sa(s.gene_names, M, len(s), fn, fraction, order)
+
+def calculate_sa_stream(datafile, fn, threshold=PRESENCE_THRESHOLD, fraction=PRESENCE_FRACTION, order=None):
+    """
+    Same as calculate_sa, but reads datafile a block of genes at a time rather than
+    loading the expression matrix, keeping only a presence count for each gene
+
+    """
+
+    gene_names = []
+    counts     = []
+    nsamples   = 0
+
+    for names, M in clustio.read_normal_chunks(datafile):
+        gene_names.extend(names)
+        counts.append((M >= threshold).sum(1))
+        nsamples = M.shape[1]
+
+    if counts:
+        counts = N.concatenate(counts)
+
+    write_sa(gene_names, counts, nsamples, fn, fraction, order)
 
 def calculate_auc(fn, fln, pathway_dict, path_names):
 
-    sa = get_sa(fn)
+    sa = get_sa(fn, fln.gene_names)
     c = create_new_symm_dset(path_names)
     Q = auc.mp_auc_matrix(fln, [ pathway_dict[x] for x in path_names ], sa, similarity=True)           
     c.M = Q        
@@ -119,7 +217,7 @@ def calculate_auc(fn, fln, pathway_dict, path_names):
 # Dec 30 2014 Deprecated while perm tests are being tweaked
 def _calculate_perm_test(fn, fln, path_lengths):
 
-    sa = get_sa(fn)
+    sa = get_sa(fn, fln.gene_names)
     M  = auc_perm.mp_auc_matrix(fln, path_lengths, sa, similarity=True, iter=ITER_PERM)
     M.sort(2)
     c = create_new_symm_dset(path_lengths)
@@ -128,7 +226,7 @@ def _calculate_perm_test(fn, fln, path_lengths):
 
 def calculate_perm_test(fn, fln, path_lengths):
 
-    sa = get_sa(fn)
+    sa = get_sa(fn, fln.gene_names)
     result_dict = auc_perm.mp_auc_matrix(fln, path_lengths, sa, similarity=True, iter=ITER_PERM)
 
     nd = dict([ (k, sorted(result_dict[k])[int(0.999 * ITER_PERM)]) for k in result_dict ])
@@ -143,15 +241,10 @@ def _calculate_sig_connections(fn, pathway_dict):
     mutualize(s)
     c = clustio.ParseNormal('auc_results/%s_perm_test.txt' % fn)
     
-    psizes = dict([ (x, len(pathway_dict[x])) for x in pathway_dict ])
     cidx   = dict([ (int(c.gene_names[i]), i) for i in xrange(len(c.gene_names)) ])
+    sidx   = N.array([ cidx[len(pathway_dict[x])] for x in s.gene_names ], dtype=int)
 
-    for i, j in comb(xrange(len(s)), 2):
-        ilen = psizes[s.gene_names[i]]
-        jlen = psizes[s.gene_names[j]]
-        thresh = c.M[cidx[ilen]][cidx[jlen]]
-        if s.M[i][j] <= thresh:
-            s.M[i][j] = s.M[j][i] = 0
+    auc.mask_matrix(s.M, c.M[N.ix_(sidx, sidx)])
 
     clustio.write_normal(s, 'sig_connections/%s_sig_connections_999.txt' % fn)
 
@@ -164,14 +257,11 @@ def calculate_sig_connections(fn, pathway_dict):
     pt = cp.load(f)
     f.close()
 
-    for i, j in comb(xrange(len(s)), 2):
-        p1 = set(pathway_dict[s.gene_names[i]])
-        p2 = set(pathway_dict[s.gene_names[j]])
-        thresh = pt[(len(p1), len(p2), len(p1 & p2))]
-        if s.M[i][j] <= thresh:
-            s.M[i][j] = s.M[j][i] = 0
+    auc.mask_matrix(s.M, auc.threshold_matrix(s.gene_names, pathway_dict, pt))
 
-    clustio.write_normal(s, 'sig_connections/%s_sig_connections_999.txt' % fn)
+    # Only the significant pairs are kept, as an edge list. See treeio.read_sig_connections
+    I, J, W = VisML.upper_triangle_edges(s.M)
+    clustio.write_edges(s.sample_ids, I, J, W, treeio.SIG_FILE % fn)
 
 # Dec 29 2014 Deprecated while perm tests are being tweaked
 def _calculate_enhancement_threshold(fn1, fn2, fln, path_lengths):
@@ -234,6 +324,7 @@ def handle_opts():
         print('\t-p, --pathways <filename>\t\tUse pathway definitions at <filename>, rather than the default (Oct 2013 KEGG definitions). Should be a pickled python dictionary.')
         print('\t-t, --test_condition <filename>\t\tTest condition data file. Tab-delimited with samples on cols and features on rows, with headers on both. e.g., tumor data.')
         print('\t-c, --control_condition <filename>\tControl condition data file. Same format as --test_condition. e.g., normal tissue data.')
+        print('\n\tAll input files may be gzip or bz2 compressed.')
         print('\n\tEXAMPLE: python ctalk.py --pathways hsa_paths --fln FLN_hsa.txt --test_condition LumA_tcga_data.txt --control_condition Normal_tcga_data.txt\n')
 
         if err is not None:
@@ -275,10 +366,10 @@ def generate_missing(settings):
     """
 
     print('Loading FLN...')
-    fln = clustio.ParseNormal(settings['FLN'])
+    fln = clustio.ParseNormal(settings['FLN'], procs=mp.cpu_count())
 
     print('Loading pathway definitions...')
-    f = open(settings['pathways'], 'r')
+    f = clustio.open_file(settings['pathways'])
     pathway_dict = cp.load(f)
     f.close()
     
@@ -288,15 +379,15 @@ def generate_missing(settings):
     print('Generating pathway length and overlap list...')
     path_lengths = sorted(calculate_overlaps(pathway_dict))
 
-    fn1 = os.path.splitext(os.path.basename(settings['test']))[0]
-    fn2 = os.path.splitext(os.path.basename(settings['control']))[0]
+    fn1 = os.path.splitext(os.path.basename(clustio.strip_compression_ext(settings['test'])))[0]
+    fn2 = os.path.splitext(os.path.basename(clustio.strip_compression_ext(settings['control'])))[0]
 
     # Final things needed are reweight_RAW, sig_connections, test_vs_control_thresh_95.txt
     # Steps:
-    # @ calculate_sa creates gene_presence/%s_top85_gt_1.txt
+    # @ calculate_sa creates gene_presence/%s_top85_gt_1.npz
     # @ * calculate_auc creates auc_results/%s_results_reweight_RAW.txt
     # * calculate_perm_test creates auc_results/%s_perm_test.txt
-    # @ calculate_sig_connections creates sig_connections/%s_sig_connections_999.txt
+    # @ calculate_sig_connections creates sig_connections/%s_sig_connections_999.npz
     # @ calculate_enhancement creates auc_results/%s_vs_%s_thresh_95.txt
     
     # * denotes activities that can occur simultaneously
@@ -307,9 +398,9 @@ def generate_missing(settings):
         print('Looking for required %s files and generating them if needed...' % fn)
         print
     
-        if not os.path.exists('gene_presence/%s_top85_gt_1.txt' % fn):
+        if not os.path.exists(SA_FILE % fn) and not os.path.exists(SA_TEXT_FILE % fn):
             print('Gene presence definitions not found, building...')
-            calculate_sa(clustio.ParseNormal(datafile), fn)
+            calculate_sa_stream(datafile, fn, order=fln.gene_names)
         else:
             print('Found gene presence definitions')
     
@@ -318,7 +409,7 @@ def generate_missing(settings):
             if not s.sample_ids == path_names:
                 del s
                 print('New pathway definitions detected! Attempting to remove old results...')
-                for f in ('auc_results/%s_results_reweight_RAW.txt' % fn, 'auc_results/%s_perm_test_4_500.txt' % fn, 'sig_connections/%s_sig_connections_999.txt' % fn, 'auc_results/%s_vs_%s_thresh_95.txt' % (fn1, fn2)):
+                for f in ('auc_results/%s_results_reweight_RAW.txt' % fn, 'auc_results/%s_perm_test_4_500.txt' % fn, treeio.SIG_FILE % fn, treeio.SIG_TEXT_FILE % fn, 'auc_results/%s_vs_%s_thresh_95.txt' % (fn1, fn2)):
                     try:
                         os.remove(f)
                     except:
@@ -336,7 +427,7 @@ def generate_missing(settings):
         else:
             print('Found permutation test results')
     
-        if not os.path.exists('sig_connections/%s_sig_connections_999.txt' % fn):
+        if not os.path.exists(treeio.SIG_FILE % fn) and not os.path.exists(treeio.SIG_TEXT_FILE % fn):
             print('Significant connection matrix not found, building...')
             calculate_sig_connections(fn, pathway_dict)
         else:
@@ -29,12 +29,24 @@ import xml.etree.ElementTree as xml
 import numpy as N
 from warnings import warn
 
-import xml.dom.minidom as minidom
-import StringIO, os, sys
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+import os, sys
+import gzip, threading, Queue
+from bisect import bisect_right
+from itertools import izip, imap
 
 VERSION = '1.35'
 DEFAULT_SPECIES = 'uno'
 
+GZIP_MAGIC      = '\x1f\x8b'
+GZIP_LEVEL      = 6           # As the gzip command line default, much faster than GzipFile's 9 for little size difference
+GZIP_BLOCK_SIZE = 1 << 20     # Bytes of XML handed to the compression thread at a time
+GZIP_QUEUE_SIZE = 4           # Blocks waiting to be compressed before writing blocks
+
 def determine_path():
     """Borrowed from wxglade.py"""
     try:
@@ -87,11 +99,11 @@ def settag(self, value, name):
             del self.attrib[name]
 
 def settext(self, value, name):
-    obj = eval(name)
+    obj = TEXT_TAGS[name]
     v = self.find(name)
 
     if value != None:
-        if v:
+        if v is not None:
             self.remove(v)
         self.append(obj(value))
     else:
@@ -137,6 +149,219 @@ def rem_from_set(prop, name):
             return list(lstcpy)
     return prop
 
+class GzipWriter(object):
+    """
+
+    Write-only gzip file which compresses in a background thread, so compression overlaps with serialization.
+    Writes are gathered into blocks of GZIP_BLOCK_SIZE bytes, and at most GZIP_QUEUE_SIZE blocks wait to be
+    compressed at a time, so memory use stays flat. zlib releases the interpreter lock while compressing.
+
+    Errors in the thread are raised by the next write, or by close
+
+    """
+
+    def __init__(self, filename, compresslevel=GZIP_LEVEL):
+
+        self._gz    = gzip.GzipFile(filename, 'wb', compresslevel)
+        self._queue = Queue.Queue(GZIP_QUEUE_SIZE)
+        self._buf   = []
+        self._size  = 0
+        self._error = None
+
+        self._thread = threading.Thread(target=self._compress)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _compress(self):
+
+        while True:
+            block = self._queue.get()
+            if block is None:
+                break
+
+            # Keep emptying the queue after an error, so the writer never blocks
+            if self._error is None:
+                try:
+                    self._gz.write(block)
+                except Exception, e:
+                    self._error = e
+
+    def _flush(self):
+
+        if self._error is not None:
+            raise self._error
+
+        if self._buf:
+            self._queue.put(''.join(self._buf))
+            self._buf  = []
+            self._size = 0
+
+    def write(self, data):
+
+        self._buf.append(data)
+        self._size += len(data)
+
+        if self._size >= GZIP_BLOCK_SIZE:
+            self._flush()
+
+    def close(self):
+
+        try:
+            self._flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._gz.close()
+
+        if self._error is not None:
+            raise self._error
+
+def open_visml(filename, mode='r', compress=None):
+    """
+
+    Opens a VisML file, transparently handling gzip.
+
+    For reading, gzipped files are recognized by their contents. For writing, the file is gzipped, by a GzipWriter,
+    if compress is True, or if compress is None and filename ends in .gz. Open file objects are returned as they are
+
+    """
+
+    if hasattr(filename, 'read') or hasattr(filename, 'write'):
+        return filename
+
+    if mode == 'r':
+        f = open(filename, 'rb')
+
+        if f.read(2) == GZIP_MAGIC:
+            f.close()
+            return gzip.GzipFile(filename, 'rb')
+
+        f.seek(0)
+        return f
+
+    if compress is None:
+        compress = filename.endswith('.gz')
+
+    if compress:
+        return GzipWriter(filename)
+
+    return open(filename, mode)
+
+def _escape(data):
+    """Escapes text and attribute values as minidom does"""
+
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+def _starttag(elem):
+    """The start tag of elem with its attributes, sorted, without the closing bracket"""
+    return '<%s%s' % (elem.tag, ''.join([ ' %s="%s"' % (name, _escape('%s' % elem.attrib[name])) for name in sorted(elem.attrib) ]))
+
+def write_pretty(f, elem, indent='', addindent='\t', newl='\n'):
+    """
+
+    Writes elem and its children to the open file f, indented as xml.dom.minidom's toprettyxml() would
+    Each element is written as it is reached, so memory use does not grow with the size of the tree
+
+    """
+
+    f.write(indent + _starttag(elem))
+
+    nodes = []
+    if elem.text:
+        nodes.append(elem.text)
+    for child in elem:
+        nodes.append(child)
+        if child.tail:
+            nodes.append(child.tail)
+
+    if not nodes:
+        f.write('/>%s' % newl)
+        return
+
+    f.write('>')
+
+    if len(nodes) == 1 and isinstance(nodes[0], basestring):
+        f.write(_escape(nodes[0]))
+    else:
+        f.write(newl)
+        for node in nodes:
+            if isinstance(node, basestring):
+                f.write('%s%s%s' % (indent + addindent, _escape(node), newl))
+            else:
+                write_pretty(f, node, indent + addindent, addindent, newl)
+        f.write(indent)
+
+    f.write('</%s>%s' % (elem.tag, newl))
+
+def upper_triangle_edges(M, allow_zero_weight=False):
+    """
+
+    Returns (i, j, weights) arrays for the entries above the diagonal of the square matrix M,
+    in row-major order. Zero entries are skipped unless allow_zero_weight is True.
+
+    Each row is scanned with a single vectorized comparison, so only the edges found are ever
+    handled individually and no full-size temporary matrix is created
+
+    """
+
+    I, J = [], []
+
+    for i in xrange(len(M) - 1):
+        if allow_zero_weight:
+            j = N.arange(i + 1, len(M))
+        else:
+            j = N.flatnonzero(M[i, i + 1:]) + (i + 1)
+
+        I.append(N.repeat(i, len(j)))
+        J.append(j)
+
+    if not I:
+        return N.zeros(0, dtype=int), N.zeros(0, dtype=int), N.zeros(0, dtype=M.dtype)
+
+    I, J = N.concatenate(I), N.concatenate(J)
+
+    return I, J, M[I, J]
+
+def read_links(filename):
+    """
+
+    Reads every node name and data link from the VisML file filename, which may be gzipped, without building
+    a VisMLTree, discarding each node as soon as it has been read.
+
+    Returns (names, sources, targets, methods, weights) arrays: node names in file order, and for each link
+    the index in names of the node it belongs to, its to attribute, its method and its weight, NaN where unset
+
+    """
+
+    names, sources, targets, methods, weights = [], [], [], [], []
+
+    f = open_visml(filename)
+
+    try:
+        for event, elem in iterparse(f, events=('start', 'end')):
+
+            if event == 'start':
+                if elem.tag == 'data':
+                    names.append(elem.get('name'))
+
+            elif elem.tag == 'link':
+                sources.append(len(names) - 1)
+                targets.append(elem.get('to'))
+                methods.append(elem.get('method'))
+                weights.append(elem.get('weight', 'nan'))
+
+            elif elem.tag in ('VNodes', 'VEdge', 'Nodes', 'Edges'):
+                elem.clear()
+    finally:
+        if f is not filename:
+            f.close()
+
+    return (N.array(names, dtype=str), N.array(sources, dtype=N.intp), N.array(targets, dtype=str),
+            N.array(methods, dtype=str), N.array(weights, dtype=N.float64))
+
 def get_node_name(node):
     assert isinstance(node, VNodes)
     if node.isduplicate:
@@ -148,6 +373,7 @@ class VisMLTree(object):
 
     def __init__(self, filename=None):
         self._index = 0
+        self._nodedict = None
 
         if filename is not None:
             self.parse(filename)
@@ -162,46 +388,84 @@ class VisMLTree(object):
             elem.validate()
 
     def parse(self, filename):
-        tree = xml.parse(filename)
-        root = tree.getroot()
+        """
+
+        Builds the tree from a VisML file, one element at a time as the file is read.
+        Each source element is discarded as soon as its VisML counterpart has been built.
+        Gzipped files are read transparently, see open_visml.
+
+        """
+
+        sources = []  # Open elements in the file
+        stack   = []  # Their VisML counterparts, or None for text elements, built once their text is read
 
-        assert root.tag == 'VisAnt'
+        self._nodedict = None
 
-        self._root = VisAnt(**root.attrib)
+        f = open_visml(filename)
 
-        for child in root.getchildren():
-            self._addbranch(self._root, child)
+        try:
+            self._parse(f, sources, stack)
+        finally:
+            if f is not filename:
+                f.close()
 
         for elem in self:
             elem._updatestatic()
 
-    def write(self, filename, prettyprint=True):
+    def _parse(self, f, sources, stack):
+
+        for event, elem in iterparse(f, events=('start', 'end')):
+
+            if event == 'start':
+                if not stack:
+                    assert elem.tag == 'VisAnt'
+                    self._root = v = VisAnt(**elem.attrib)
+                elif elem.tag in TEXT_TAGS:
+                    v = None
+                else:
+                    v = self._newelement(stack[-1], elem)
+
+                sources.append(elem)
+                stack.append(v)
+                continue
+
+            sources.pop()
+            v = stack.pop()
+
+            if v is None:
+                self._newelement(stack[-1], elem)
+
+            elem.clear()
+            if sources:
+                sources[-1].remove(elem)
+
+    def write(self, filename, prettyprint=True, compress=None):
         """
         
-        Setting the "prettyprint" keyword enables nicely-formatted output via the python xml minidom module
+        Setting the "prettyprint" keyword enables nicely-formatted output, in the same format as
+        the python xml minidom module's toprettyxml()
 
-        This is very memory-intensive, so if your xml tree is large, set it to False
+        Either way the tree is written to the file one element at a time, so no copy of the document is held in memory
+
+        The file is gzipped, with compression in a background thread, if compress is True or if compress is None
+        and filename ends in .gz. See open_visml
 
         """
 
         for elem in self:
             elem._updatestatic()
         
-        stringout = StringIO.StringIO()
-        xml.ElementTree(self._root).write(stringout, xml_declaration=True, encoding="utf-8")
-        
-        # Hack to allow prettyprint through xml.dom.minidom
+        f = open_visml(filename, 'w', compress)
 
-        if prettyprint:
-            output = minidom.parseString(stringout.getvalue()).toprettyxml()
-        else:
-            output = stringout.getvalue()
-
-        stringout.close()
-        
-        f = open(filename, 'w')
-        f.write(output)
-        f.close()
+        try:
+            if prettyprint:
+                f.write('<?xml version="1.0" ?>\n')
+                write_pretty(f, self._root)
+            else:
+                xml.ElementTree(self._root).write(f, xml_declaration=True, encoding="utf-8")
+        finally:
+            if f is not filename:
+                f.close()
 
     @property
     def nodes(self):
@@ -218,6 +482,39 @@ class VisMLTree(object):
         """A list of edges in the network"""
         return self._root.edges
 
+    @property
+    def _node_dict(self):
+        """
+        
+        Dict of node names, and duplicate uids, to the nodes themselves. Built on first use and kept up to date by
+        the VisMLTree methods which add and remove nodes, so nodes should be added and removed through those.
+        Renaming a node in place is not detected.
+
+        """
+
+        if self._nodedict is None:
+            nd = {}
+            for node in self.nodes or []:
+                nd.setdefault(node.name, node)
+                for dup in node.duplicates or []:
+                    nd.setdefault(dup.uid, dup)
+            self._nodedict = nd
+
+        return self._nodedict
+
+    def _register_node(self, node):
+
+        if self._nodedict is not None:
+            self._nodedict.setdefault(get_node_name(node), node)
+
+    def get_node(self, name):
+        """Returns the node with the given name, or duplicate with the given uid, or None"""
+        return self._node_dict.get(name)
+
+    def get_edge(self, node1, node2):
+        """Returns the VEdge between node1 and node2, either node names or node objects, or None"""
+        return self._edges.get_edge(node1, node2)
+
     @property
     def _nodes(self):
         """The object itself, rather than a list of nodes"""
@@ -268,6 +565,90 @@ class VisMLTree(object):
             node1.add_link(node2.name, method, **attrib)
             node2.add_link(node1.name, method, **attrib)
 
+    def add_edges(self, nodes, I, J, weights=None, methods='M0099'):
+        """
+
+        Creates an edge between nodes[I[k]] and nodes[J[k]] for every k, as add_edge would, where nodes is a
+        sequence of nodes or node names, such as the list returned by add_nodes, and I and J are index arrays.
+
+        weights, if given, is an array of edge weights aligned to I and J, NaN where unset. methods is either a single method
+        or an array of methods aligned to I and J.
+
+        Pairs which are already connected are skipped. Duplicate nodes are not supported, use add_edge instead.
+
+        """
+
+        nodes = [ self.get_node(x) if isinstance(x, basestring) else x for x in nodes ]
+
+        for node in nodes:
+            if not isinstance(node, VNodes) or node.isduplicate:
+                raise ValueError, 'Arguments should be of type VNodes, and not duplicates'
+
+        I, J = N.asarray(I).tolist(), N.asarray(J).tolist()
+
+        if isinstance(methods, basestring):
+            methods = [methods] * len(I)
+        else:
+            methods = list(methods)
+
+        for m in set(methods):
+            if not (m[:1] == 'M' and m[1:].isdigit()):
+                warn('Method name should be of the form M####, where # are integers')
+
+        if weights is None:
+            weights = [None] * len(I)
+        else:
+            W = N.asarray(weights)
+            weights = W.astype(str).tolist()
+
+            if W.dtype.kind == 'f':
+                for k in N.flatnonzero(N.isnan(W)).tolist():
+                    weights[k] = None
+
+        names = [ x.name for x in nodes ]
+        datas = [ x.data for x in nodes ]
+
+        edges = self._edges
+        ed, ei = edges._edge_dict, edges._edge_index
+
+        for i, j, w, m in izip(I, J, weights, methods):
+            n1, n2 = names[i], names[j]
+
+            if n1 in ed and n2 in ed[n1]:
+                continue
+
+            edge = VEdge._fromattrib({'from': n1, 'to': n2})
+            edges.append(edge)
+
+            ed.setdefault(n1, set()).add(n2)
+            ed.setdefault(n2, set()).add(n1)
+            ei[(n1, n2)] = ei[(n2, n1)] = edge
+
+            a1, a2 = {'to': n2, 'method': m}, {'to': n1, 'method': m}
+            if w is not None:
+                a1['weight'] = a2['weight'] = w
+
+            datas[i].append(link._fromattrib(a1))
+            if i != j:
+                datas[j].append(link._fromattrib(a2))
+
+    def add_edges_from_matrix(self, nodes, M, methods='M0099', allow_zero_weight=False):
+        """
+
+        Creates an edge for each nonzero entry above the diagonal of the symmetric matrix M, weighted by that entry,
+        between the nodes aligned to its rows and columns. Zero entries are included if allow_zero_weight is True.
+
+        methods may be a single method or a matrix of methods the same shape as M. See add_edges.
+
+        """
+
+        I, J, W = upper_triangle_edges(M, allow_zero_weight)
+
+        if not isinstance(methods, basestring):
+            methods = N.asarray(methods)[I, J]
+
+        self.add_edges(nodes, I, J, W, methods)
+
     def remove_edge(self, node1, node2):
         # TODO This doesn't support unidirectional linkage removal, since add_edge doesn't support adding them
         try:
@@ -275,15 +656,27 @@ class VisMLTree(object):
         except:
             raise ValueError, 'Arguments should be of type VNodes'
 
+        edge = self._unlink(node1, node2)
+        if edge is not None:
+            self._edges.remove(edge)
+
+    def _unlink(self, node1, node2):
+        """
+
+        Removes the edge between nodes node1 and node2 from the edge indexes, along with the links between them.
+        Returns the VEdge, which is left in the edge list for the caller to remove, or None if there is none
+
+        """
+
         node1_name = get_node_name(node1)
         node2_name = get_node_name(node2)
 
         if not self.isconnected(node1_name, node2_name):
-            return
+            return None
 
         # XXX If there can be multiple edge links via different methods, this function will not clean up properly!
 
-        self._edges.remove_edge(node1, node2)
+        edge = self._edges._pop_edge(node1_name, node2_name)
 
         if node1.isduplicate:
             node1 = node1.parent
@@ -293,6 +686,8 @@ class VisMLTree(object):
         node1.remove_link(node2_name)
         node2.remove_link(node1_name)
 
+        return edge
+
     def remove_node_from_metanode(self, node, metanode):
         """
         Removes node from group metanode
@@ -327,32 +722,86 @@ class VisMLTree(object):
 
         Extensive cleanup must be performed
 
+        Other nodes are found through the node, edge and group indexes rather than by scanning the network,
+        so group memberships are expected to have been set through add_node_to_metanode
+
+        Each of the node's elements is then found by a scan of the node or edge list, so use remove_nodes
+        to remove many nodes at once
+
+        """
+
+        dead_nodes = set()
+        dead_edges = set()
+
+        self._remove_node(node, dead_nodes, dead_edges)
+
+        for x in dead_nodes:
+            self._nodes.remove(x)
+        for x in dead_edges:
+            self._edges.remove(x)
+
+    def remove_nodes(self, nodes):
         """
+
+        Removes each of the given nodes, as remove_node does.
+
+        The removed nodes and edges are only marked as each node is cleaned up, and the node and edge lists
+        are rebuilt once at the end, so pruning many nodes takes time linear in the size of the network
+
+        """
+
+        dead_nodes = set()
+        dead_edges = set()
+
+        for node in nodes:
+            self._remove_node(node, dead_nodes, dead_edges)
+
+        if dead_nodes:
+            self._nodes[:] = [ x for x in self._nodes if x not in dead_nodes ]
+        if dead_edges:
+            self._edges[:] = [ x for x in self._edges if x not in dead_edges ]
+
+    def _remove_node(self, node, dead_nodes, dead_edges):
+        """Cleans up after node for remove_nodes, adding it and its edges to the sets of elements to drop"""
+
         node_name = get_node_name(node)
+        nd = self._node_dict
 
         if node.isduplicate:
+            groups = node.group and [node.group] or []
             node.parent.remove(node)
         else:
+            groups = node.groups or []
+
             # Delete all duplicates
             if node.duplicates is not None:
                 for n in node.duplicates:
-                    self.remove_node(n)
+                    self._remove_node(n, dead_nodes, dead_edges)
         
-            # If the node is a metanode, remove all group references from other nodes
+            # If the node is a metanode, remove all group references from its children
             if node.ismetanode:
-                for n in self.nodes:
-                    n.remove_group(node.name)
+                for name in node.children or []:
+                    n = nd.get(name)
+                    if n is not None:
+                        self.remove_node_from_metanode(n, node)
 
-            self._nodes.remove(node)
+            dead_nodes.add(node)
 
         # Remove all edges connected to the node
-        for n in self.nodes:
-            if self.isconnected(n, node):
-                self.remove_edge(n, node)
+        for name in list(self._edges._edge_dict.get(node_name, ())):
+            n = nd.get(name)
+            if n is not None:
+                edge = self._unlink(n, node)
+                if edge is not None:
+                    dead_edges.add(edge)
+
+        if nd.get(node_name) is node:
+            del nd[node_name]
     
         # Finally, if any metanodes have this as a child, remove those references
-        for n in self.nodes:
-            if n.ismetanode:
+        for name in groups:
+            n = nd.get(name)
+            if n is not None and n.ismetanode:
                 n.remove_child(node_name)
 
     def add_node(self, name, x, y, w='16', h='16', vlabel=None, **attrib):
@@ -360,18 +809,48 @@ class VisMLTree(object):
         index = self._inc_index()
 
         node = self._nodes.add_node(name, x, y, '0', index, w=w, h=h, vlabel=vlabel, **attrib)
+        self._register_node(node)
         return node
 
+    def add_nodes(self, names, x='0', y='0', w='16', h='16'):
+        """
+
+        Adds a plain node for each name in names, all at the same position and size, as add_node would.
+        The elements are built directly rather than through their property setters.
+
+        Returns the list of new nodes, in the same order as names
+
+        """
+
+        start = self._index
+        nodes = []
+
+        for k, name in enumerate(names):
+            node = VNodes._fromattrib({'x': x, 'y': y, 'w': w, 'h': h}, visible=True, duplicate_index=-1)
+            node.append(data._fromattrib({'name': str(name), 'index': str(start + k + 1), 'type': '0'}, ismetanode=None))
+            nodes.append(node)
+
+        self._index += len(nodes)
+        self._nodes.extend(nodes)
+
+        for node in nodes:
+            self._register_node(node)
+
+        return nodes
+
     def duplicate_node(self, node, x, y, vlabel=None, **attrib):
 
         index = self._inc_index()
-        return node.add_duplicate(x, y, index, vlabel=vlabel, **attrib)
+        dup = node.add_duplicate(x, y, index, vlabel=vlabel, **attrib)
+        self._register_node(dup)
+        return dup
 
     def add_metanode(self, name, x, y, vlabel=None, children=None, **attrib):
 
         index = self._inc_index()
 
         node = self._nodes.add_node(name, x, y, '3', index, vlabel=vlabel, children=children, **attrib)
+        self._register_node(node)
         return node
 
     def add_node_to_metanode(self, node, metanode, duplicate=True):
@@ -431,32 +910,295 @@ class VisMLTree(object):
         self._index += 1
         return str(self._index)
 
-    def _addbranch(self, root, child):
+    def _newelement(self, root, child):
+        """Builds the VisML element for the source element child and appends it to root. Text elements require their text"""
 
         if 'index' in child.attrib:
             self._index = max(self._index, int(child.get('index')))
 
-        try:
-            obj = eval(child.tag)
-        except:
-            raise ValueError('Unrecognized tag %s' % child.tag)
-
-        if child.tag in ('method', 'pathway', 'VScreen', 'exLink', 'Nodes', 'VNodes', 'id', 'group', 'Dup', 'link', 'data', 'Edges', 'VEdge'):
-            v = obj(**child.attrib)
-        elif child.tag in ('vlabel', 'children', 'desc'):
-            v = obj(child.text)
+        if child.tag in ATTRIB_TAGS:
+            v = ATTRIB_TAGS[child.tag](**child.attrib)
+        elif child.tag in TEXT_TAGS:
+            v = TEXT_TAGS[child.tag](child.text)
         else:
-            raise NotImplementedError('Unimplemented tag %s' % child.tag)
+            raise ValueError('Unrecognized tag %s' % child.tag)
 
         if child.tag == 'Dup':
             v.parent = root
 
         root.append(v)
+
+        return v
+
+    def _addbranch(self, root, child):
+
+        v = self._newelement(root, child)
         
         for c in child.getchildren():
             self._addbranch(v, c)
 
 
+class VisMLGraph(object):
+    """
+
+    Array-backed alternative to VisMLTree for large plain networks, such as those built by add_nodes and add_edges:
+    nodes without duplicates or groups, and at most one edge between each pair of nodes.
+
+    Node names are kept in a list and edge endpoints, weights and method codes in arrays. VNodes and VEdge elements
+    are only built when asked for through node, edge or to_tree, or one at a time while writing, and are new copies
+    each time, so changes made to them are not kept.
+
+    """
+
+    def __init__(self, default_methods_file=DEFAULT_METHODS_FILE, **attrib):
+
+        self._tree       = create_empty_visml_tree(default_methods_file, **attrib) # Root element and methods only
+        self._names      = []
+        self._nodestart  = []   # First node added by each call to add_nodes
+        self._nodeattrib = []   # and the VNodes attributes it was given
+        self._methods    = []   # Method ids, indexed by method code
+        self._chunks     = []   # (I, J, weights, method codes) for each call to add_edges
+        self._nameindex  = None
+        self._links      = None # (edges, offsets), each node's edges in order. None if edges were added since
+
+    def __len__(self):
+        return len(self._names)
+
+    @property
+    def names(self):
+        """Node names, in node order"""
+        return list(self._names)
+
+    def add_method(self, name, desc, type, visible=None, weight=None, species=None, color=None):
+        """See VisMLTree.add_method"""
+        self._tree.add_method(name, desc, type, visible=visible, weight=weight, species=species, color=color)
+
+    def add_nodes(self, names, x='0', y='0', w='16', h='16'):
+        """Adds a plain node for each name in names, as VisMLTree.add_nodes would. Returns an array of their indices"""
+
+        start = len(self._names)
+
+        self._names.extend([ str(name) for name in names ])
+        self._nodestart.append(start)
+        self._nodeattrib.append({'x': x, 'y': y, 'w': w, 'h': h})
+        self._nameindex = None
+        self._links = None
+
+        return N.arange(start, len(self._names))
+
+    def add_edges(self, I, J, weights=None, methods='M0099'):
+        """
+
+        Adds an edge between nodes I[k] and J[k] for every k, where I and J are arrays of node indices.
+
+        weights, if given, is an array of edge weights aligned to I and J. NaN weights are left unset.
+        methods is either a single method or an array of methods aligned to I and J.
+
+        As with VisMLTree.add_edges, an edge between a pair of nodes which is already connected is ignored
+
+        """
+
+        I, J = N.asarray(I, dtype=N.intp), N.asarray(J, dtype=N.intp)
+
+        if I.shape != J.shape or I.ndim != 1:
+            raise ValueError, 'I and J should be index arrays of the same length'
+
+        if len(I) and (min(I.min(), J.min()) < 0 or max(I.max(), J.max()) >= len(self._names)):
+            raise ValueError, 'Node index out of range'
+
+        if weights is None:
+            W = N.empty(len(I), dtype=N.float32)
+            W.fill(N.nan)
+        else:
+            W = N.asarray(weights)
+            if W.shape != I.shape:
+                raise ValueError, 'weights should be aligned to I and J'
+
+        if isinstance(methods, basestring):
+            codes = N.repeat(N.uint16(self._method_code(methods)), len(I))
+        else:
+            ids, inv = N.unique(N.asarray(methods), return_inverse=True)
+            if inv.shape != I.shape:
+                raise ValueError, 'methods should be aligned to I and J'
+            codes = N.array([ self._method_code(str(m)) for m in ids ], dtype=N.uint16).take(inv)
+
+        self._chunks.append((I, J, W, codes))
+        self._links = None
+
+    def add_edges_from_matrix(self, M, methods='M0099', allow_zero_weight=False):
+        """
+
+        Adds an edge for each nonzero entry above the diagonal of the symmetric matrix M, weighted by that entry,
+        where the rows and columns of M are aligned to the nodes. See VisMLTree.add_edges_from_matrix
+
+        """
+
+        I, J, W = upper_triangle_edges(M, allow_zero_weight)
+
+        if not isinstance(methods, basestring):
+            methods = N.asarray(methods)[I, J]
+
+        self.add_edges(I, J, W, methods)
+
+    def edge_arrays(self):
+        """
+
+        Returns (I, J, weights, methods) arrays describing the edges in the order they were added, where I and J
+        are node indices, weights are NaN where unset and methods are method ids
+
+        """
+
+        I, J, W, C = self._edges()
+
+        return I, J, W, N.array(self._methods or [''], dtype=str).take(C)
+
+    def node(self, i):
+        """Builds the VNodes element for node i, given by index or name, including its data and links"""
+
+        if isinstance(i, basestring):
+            i = self._node_index(i)
+
+        I, J, W, C = self._edges()
+        eids, offsets = self._links
+        names = self._names
+
+        attrib = self._nodeattrib[bisect_right(self._nodestart, i) - 1]
+        node   = VNodes._fromattrib(attrib, visible=True, duplicate_index=-1)
+        d      = data._fromattrib({'name': names[i], 'index': str(i + 1), 'type': '0'}, ismetanode=None)
+
+        for k in eids[offsets[i]:offsets[i + 1]].tolist():
+            a = {'to': names[J[k] if I[k] == i else I[k]], 'method': self._methods[C[k]]}
+            if W[k] == W[k]:
+                a['weight'] = str(W[k])
+            d.append(link._fromattrib(a))
+
+        node.append(d)
+
+        return node
+
+    def edge(self, k):
+        """Builds the VEdge element for edge k, indexed as in edge_arrays"""
+
+        I, J = self._edges()[:2]
+        return VEdge._fromattrib({'from': self._names[I[k]], 'to': self._names[J[k]]})
+
+    def to_tree(self):
+        """Builds the equivalent VisMLTree, with every element materialized"""
+
+        tree = VisMLTree()
+        tree._root = root = VisAnt(**self._tree._root.attrib)
+
+        for child in self._tree._root:
+            if child.tag == 'Nodes':
+                tree._newelement(root, child).extend(imap(self.node, xrange(len(self))))
+            elif child.tag == 'Edges':
+                tree._newelement(root, child).extend(imap(self.edge, xrange(len(self._edges()[0]))))
+            else:
+                tree._addbranch(root, child)
+
+        tree._index = len(self)
+
+        for elem in tree:
+            elem._updatestatic()
+
+        return tree
+
+    def write(self, filename, prettyprint=True, compress=None):
+        """
+
+        Writes the network as VisMLTree.write would. With prettyprint, the default, each node and edge element
+        is built, written and discarded in turn. Otherwise the whole tree is built first, see to_tree
+
+        """
+
+        if not prettyprint:
+            self.to_tree().write(filename, prettyprint=False, compress=compress)
+            return
+
+        root = self._tree._root
+        settag(root, str(len(self)), 'nodecount')
+
+        counts = {'Nodes': (self.node, len(self)), 'Edges': (self.edge, len(self._edges()[0]))}
+
+        f = open_visml(filename, 'w', compress)
+
+        try:
+            f.write('<?xml version="1.0" ?>\n%s>\n' % _starttag(root))
+
+            for child in root:
+                if not counts.get(child.tag, (None, 0))[1]:
+                    write_pretty(f, child, '\t')
+                    continue
+
+                build, n = counts[child.tag]
+
+                f.write('\t%s>\n' % _starttag(child))
+                for i in xrange(n):
+                    elem = build(i)
+                    elem._updatestatic()
+                    write_pretty(f, elem, '\t\t')
+                f.write('\t</%s>\n' % child.tag)
+
+            f.write('</VisAnt>\n')
+        finally:
+            if f is not filename:
+                f.close()
+
+    def _node_index(self, name):
+
+        if self._nameindex is None:
+            self._nameindex = {}
+            for i in xrange(len(self._names) - 1, -1, -1):
+                self._nameindex[self._names[i]] = i
+
+        try:
+            return self._nameindex[name]
+        except KeyError:
+            raise ValueError, 'No node named %s' % name
+
+    def _method_code(self, name):
+
+        if name not in self._methods:
+            if not (name[:1] == 'M' and name[1:].isdigit()):
+                warn('Method name should be of the form M####, where # are integers')
+            self._methods.append(name)
+
+        return self._methods.index(name)
+
+    def _edges(self):
+        """
+
+        Joins the edge chunks into one, keeping only the first edge between each pair of nodes,
+        and indexes each node's edges, in order, for building its links
+
+        """
+
+        if self._links is None:
+            if self._chunks:
+                I, J, W, C = [ N.concatenate(x) for x in zip(*self._chunks) ]
+            else:
+                I, J, W, C = N.zeros(0, N.intp), N.zeros(0, N.intp), N.zeros(0, N.float32), N.zeros(0, N.uint16)
+
+            pairs = N.minimum(I, J).astype(N.int64) * len(self._names) + N.maximum(I, J)
+            first = N.sort(N.unique(pairs, return_index=True)[1])
+
+            if len(first) < len(I):
+                I, J, W, C = I[first], J[first], W[first], C[first]
+
+            self._chunks = [(I, J, W, C)]
+
+            # Links are stored by both end nodes, once for self-loops, each node's in edge order
+            k      = N.arange(len(I))
+            loop   = I == J
+            ends   = N.concatenate((I, J[~loop]))
+            eids   = N.concatenate((k, k[~loop]))
+            order  = N.lexsort((eids, ends))
+
+            self._links = (eids[order], N.searchsorted(ends[order], N.arange(len(self._names) + 1)))
+
+        return self._chunks[0]
+
+
 class VisMLElement(xml.Element):
     """
     Base class for VisML elements
@@ -468,6 +1210,21 @@ class VisMLElement(xml.Element):
 
         xml.Element.__init__(self, elementname)
 
+    @classmethod
+    def _fromattrib(cls, attrib, **state):
+        """
+
+        Builds an element of this class straight from a dict of final attribute values, skipping __init__ and its
+        property setters. Any instance state normally set by __init__ must be given as keywords
+
+        """
+
+        elem = cls.__new__(cls)
+        xml.Element.__init__(elem, cls.__name__, attrib)
+        elem.__dict__.update(state)
+
+        return elem
+
     def __delitem__(self, x):
 
         warnings.warn('WARNING: Deletion of child elements bugged, try parentelement.remove(child) instead') # TODO
@@ -1119,6 +1876,9 @@ class VNodes(VisMLElement):
     def remove_link(self, name):
         self.data.remove_link(name)
 
+    def get_link(self, target):
+        return self.data.get_link(target)
+
     def _inc_dup_index(self):
         self.duplicate_index += 1
         return str(self.duplicate_index)
@@ -1800,26 +2560,46 @@ class data(VisMLElement):
 
         return True
     
+    def _link_dict(self):
+        """
+
+        Dict of link targets to links, rebuilt whenever the number of children has changed since it was last used.
+        Changing the target of an existing link in place is not detected.
+
+        """
+
+        cached = self.__dict__.get('_links')
+
+        if cached is None or cached[0] != len(self):
+            ld = {}
+            for edge in self.findall('link'):
+                ld.setdefault(edge.target, edge)
+            cached = self._links = (len(self), ld)
+
+        return cached[1]
+
+    def get_link(self, target):
+        """Returns the link to target, a node name or duplicate uid, or None"""
+        return self._link_dict().get(target)
+
     def add_link(self, to, method, **attrib):
-        # TODO: dict
         target = to
         if 'toDup' in attrib:
             target = attrib['toDup']
 
-        if self.links is not None:
-            for edge in self.links:
-                if edge.target == target:
-                    return
+        ld = self._link_dict()
+        if target in ld:
+            return
 
-        self.append(link(to=to, method=method, **attrib))
+        ld[target] = link(to=to, method=method, **attrib)
+        self.append(ld[target])
+        self._links = (len(self), ld)
 
     def remove_link(self, target):
-        # TODO: dict
-        if self.links is not None:
-            for edge in self.links:
-                if edge.target == target:
-                    self.remove(edge)
-                    return
+        ld = self._link_dict()
+        if target in ld:
+            self.remove(ld.pop(target))
+            self._links = (len(self), ld)
 
     def remove_group(self, name):
         self.groups = rem_from_set(self.groups, name)
@@ -1978,6 +2758,7 @@ class Edges(VisMLElement):
         self.exclude_meta = exclude_meta
         self.opacity = opacity
         self._edge_dict = {}
+        self._edge_index = {}
 
     def validate(self):
 
@@ -1998,6 +2779,16 @@ class Edges(VisMLElement):
             return True
         return False
 
+    def get_edge(self, node1, node2):
+        """Returns the VEdge between node names or nodes node1 and node2, in either direction, or None"""
+
+        if isinstance(node1, VNodes):
+            node1 = get_node_name(node1)
+        if isinstance(node2, VNodes):
+            node2 = get_node_name(node2)
+
+        return self._edge_index.get((node1, node2))
+
     def add_edge(self, node1, node2, **attrib):
         """
         Helper function to create an edge between node1 and node2
@@ -2017,6 +2808,7 @@ class Edges(VisMLElement):
             
             self._edge_dict.setdefault(node1_name, set()).add(node2_name)
             self._edge_dict.setdefault(node2_name, set()).add(node1_name)
+            self._edge_index[(node1_name, node2_name)] = self._edge_index[(node2_name, node1_name)] = edge
 
     def remove_edge(self, node1, node2):
         """
@@ -2025,18 +2817,26 @@ class Edges(VisMLElement):
 
         """
 
+        edge = self._pop_edge(node1, node2)
+        if edge is not None:
+            self.remove(edge)
+
+    def _pop_edge(self, node1, node2):
+        """Removes the edge between node names or nodes node1 and node2 from the indexes only, and returns it, or None"""
+
         if isinstance(node1, VNodes):
-            node1_name = get_node_name(node1)
+            node1 = get_node_name(node1)
         if isinstance(node2, VNodes):
-            node2_name = get_node_name(node2)
+            node2 = get_node_name(node2)
+
+        edge = self._edge_index.pop((node1, node2), None)
+        self._edge_index.pop((node2, node1), None)
 
-        if self.isconnected(node1_name, node2_name):
-            for edge in self.edges:
-                if (edge.linkFrom == node1_name and edge.to == node2_name) or (edge.linkFrom == node2_name and edge.to == node1_name):
-                    self.remove(edge)
-                    self._edge_dict[node1_name].remove(node2_name)
-                    self._edge_dict[node2_name].remove(node1_name)
-                    return
+        if edge is not None:
+            self._edge_dict[node1].discard(node2)
+            self._edge_dict[node2].discard(node1)
+
+        return edge
 
     @property
     def edges(self):
@@ -2076,12 +2876,16 @@ class Edges(VisMLElement):
 
     def _updatestatic(self):
         ed  = {}
+        ei  = {}
 
         for edge in self.edges:
             ed.setdefault(edge.linkFrom, set()).add(edge.to)
             ed.setdefault(edge.to, set()).add(edge.linkFrom)
+            ei.setdefault((edge.linkFrom, edge.to), edge)
+            ei.setdefault((edge.to, edge.linkFrom), edge)
 
         self._edge_dict = ed
+        self._edge_index = ei
 
 
 class VEdge(VisMLElement):
@@ -2158,3 +2962,8 @@ class VEdge(VisMLElement):
             warn('la should be boolean')
         settag(self, value, 'la')
 
+
+# Tag to class tables used when parsing. Elements are built from their attributes or from their text
+ATTRIB_TAGS = {'method': method, 'pathway': pathway, 'VScreen': VScreen, 'exLink': exLink, 'Nodes': Nodes, 'VNodes': VNodes, 'id': id,
+               'group': group, 'Dup': Dup, 'link': link, 'data': data, 'Edges': Edges, 'VEdge': VEdge}
+TEXT_TAGS   = {'vlabel': vlabel, 'children': children, 'desc': desc}
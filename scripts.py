@@ -26,8 +26,7 @@ import os
 import numpy as N
 
 from itertools import combinations as comb
-from clustio.parsers import SampleData
-from copy import deepcopy
+from itertools import chain
 
 from clustio import *
 
@@ -37,9 +36,9 @@ def transpose_sdata(s):
     s.M = s.M.T.astype(N.float32)
 
     gl   = list(s.gene_names)
-    sids = list([ x.sample_id for x in s.samples ])
+    sids = list(s.sample_ids)
 
-    s.samples    = [ parsers.SampleData(sample_id = x) for x in gl ]
+    s.samples    = parsers.SampleTable(gl)
     s.gene_names = N.array(sids)
 
     return s
@@ -63,27 +62,23 @@ def scale_to_set(sdata, *filenames):
 
     defined_clusters = list_or_files(*filenames)
 
-    sample_id_list    = [ x.sample_id for x in sdata.samples ]
-    samples_to_keep   = sum([ defined_clusters[x] for x in defined_clusters ], [])
-    sample_indices    = argintersect(sample_id_list, samples_to_keep)
+    samples_to_keep   = list(chain(*defined_clusters.values()))
+    sample_indices    = index_intersect(sdata.sample_index, samples_to_keep)
     
     sample_classes    = dict([ (defined_clusters[k][i], k) for k in defined_clusters
                                for i in xrange(len(defined_clusters[k])) ])
 
     #Adjustment
-    new_sdata.samples = [ SampleData(cluster_id=sdata.samples[i].cluster_id, sample_id=sdata.samples[i].sample_id,
-                                     sample_num=sdata.samples[i].sample_num, index=sdata.samples[i].index,
-                                     sample_class=sample_classes[sdata.samples[i].sample_id]) for i in sample_indices ]
+    new_sdata.samples = sdata.samples.take(sample_indices)
+    new_sdata.samples.sample_class = [ sample_classes[x] for x in new_sdata.samples.sample_id ]
 
     new_sdata.M = sdata.M.take(tuple(sample_indices), 0)
     new_sdata.gene_names = sdata.gene_names.copy()
 
-    sample_id_list = new_sdata.sample_ids
+    sample_index = new_sdata.sample_index
     
     for name in defined_clusters: #If samples aren't in the main, ignore them
-        sample_list = defined_clusters[name]
-        def_indices = argintersect(sample_list, sample_id_list)
-        defined_clusters[name] = [ sample_list[x] for x in def_indices ]
+        defined_clusters[name] = [ x for x in defined_clusters[name] if x in sample_index ]
 
     return new_sdata, defined_clusters
 
@@ -103,13 +98,13 @@ def scale_probes(sdata, *filenames):
 
     new_sdata = parsers.NullParser()
 
-    plist = sum(list_or_files(*filenames).values(), [])
+    plist = list(chain(*list_or_files(*filenames).values()))
 
-    probes_to_keep = tuple(argintersect(sdata.gene_names, plist))
+    probes_to_keep = tuple(index_intersect(sdata.gene_index, plist))
 
     new_sdata.M = sdata.M.take(probes_to_keep, 1)
     new_sdata.gene_names = sdata.gene_names.take(probes_to_keep)
-    new_sdata.samples = [ deepcopy(x) for x in sdata.samples ]
+    new_sdata.samples = sdata.samples.copy()
 
     return new_sdata
 
@@ -126,7 +121,7 @@ def new_defined_clusters(sdata, conv):
     """
     
     new_clusts = {}
-    s_ids = [x.sample_id for x in sdata.samples]
+    s_ids = sdata.sample_ids
 
     for s_id in s_ids:
         if s_id in conv:
@@ -142,7 +137,7 @@ def create_network_from_sdata(s, weighted=False):
 
     # Are we dealing with a similarity graph?
     assert s.M.shape[0] == s.M.shape[1]
-    assert (N.array([ x.sample_id for x in s.samples ]) == s.gene_names).all()
+    assert (N.array(s.sample_ids) == s.gene_names).all()
 
     G = nx.Graph()
 
@@ -159,79 +154,167 @@ def create_network_from_sdata(s, weighted=False):
 
     return G
 
-def create_visml_from_sdata(s, distance='euclidean', dmatrix=False, allow_zero_weight=False):
+def create_visml_from_sdata(s, distance='euclidean', dmatrix=False, allow_zero_weight=False, compact=False):
+    """
+
+    Creates a VisML tree with a node for each sample and an edge for each nonzero entry of the upper triangle
+    of the distance matrix between samples, normalized to [0,1].
+
+    distance is any metric name accepted by scipy.spatial.distance.pdist.
+    If dmatrix is True, s.M is used as the distance matrix instead.
+
+    If compact is True, an array-backed VisML.VisMLGraph is returned instead of a VisMLTree, which is much
+    smaller for large networks but cannot be edited beyond adding nodes and edges.
+
+    """
 
     from pyvisml import VisML
     
     if not dmatrix:
-        import scipy
-        dm = eval('scipy.spatial.distance.%s' % distance)
-    
-        # Distance matrix M
-        M = N.zeros((s.M.shape[0], s.M.shape[0]), dtype=N.float32)
-        for i, j in comb(xrange(len(s)), 2):
-            M[i][j] = dm(s.M[i], s.M[j])
+        from scipy.spatial.distance import pdist
+
+        # Distance matrix M, upper triangle only
+        n = s.M.shape[0]
+        M = N.zeros((n, n), dtype=N.float32)
+        M[N.triu_indices(n, 1)] = pdist(s.M, distance)
     
         # Normed to [0,1]
         M /= M.max()
     else:
         M = s.M
 
+    if compact:
+        tree = VisML.VisMLGraph(layout='elegant:100', fineArt='False')
+        tree.add_nodes(s.sample_ids)
+        tree.add_edges_from_matrix(M, allow_zero_weight=allow_zero_weight)
+
+        return tree
+
     tree = VisML.create_empty_visml_tree(layout='elegant:100', fineArt='False')
 
-    nodes = []
-    for name in s.sample_ids:
-        nodes.append(tree.add_node(name, '0', '0'))
+    nodes = tree.add_nodes(s.sample_ids)
+    tree.add_edges_from_matrix(nodes, M, allow_zero_weight=allow_zero_weight)
 
-    for i, j in comb(xrange(len(s)), 2):
-        if M[i][j] or allow_zero_weight:
-            tree.add_edge(nodes[i], nodes[j], weight=str(M[i][j]))
+    return tree
+
+def create_visml_from_edges(filename, compact=False):
+    """
+
+    Creates a VisML tree from a sparse network written by clustio.write_edges, as create_visml_from_sdata
+    would from the equivalent matrix, but without ever scanning a matrix. Edge categories are used as
+    VisML methods, with M0099 for edges without one.
+
+    If compact is True, an array-backed VisML.VisMLGraph is returned instead of a VisMLTree
+
+    """
+
+    from pyvisml import VisML
+
+    names, I, J, W, categories = read_edges(filename)
+
+    methods = N.where(categories == '', 'M0099', categories).tolist()
+
+    if compact:
+        tree = VisML.VisMLGraph(layout='elegant:100', fineArt='False')
+        tree.add_nodes(names)
+        tree.add_edges(I, J, W, methods)
+
+        return tree
+
+    tree = VisML.create_empty_visml_tree(layout='elegant:100', fineArt='False')
+
+    nodes = tree.add_nodes(names)
+    tree.add_edges(nodes, I, J, W, methods)
 
     return tree
 
-def create_sdata_from_visml(tree, methods=[]):
+def visml_edges(tree):
+    """
+
+    Returns (names, I, J, weights, methods) arrays describing the edges of the VisMLTree tree, suitable for
+    clustio.write_edges, where names are the node names and each edge takes its weight, NaN if unset,
+    and method from the link stored by its first node. Duplicate nodes are not supported
+
     """
-    Creates a symmetric SampleData object from tree, incorporating only those links in methods if given
+
+    names = [ x.name for x in tree.nodes or [] ]
+    pos   = dict([ (names[i], i) for i in xrange(len(names)) ])
+
+    I, J, W, methods = [], [], [], []
+
+    for edge in tree.edges or []:
+        if edge.linkFrom not in pos or edge.to not in pos:
+            raise ValueError, 'Edge between %s and %s joins a duplicate or unknown node' % (edge.linkFrom, edge.to)
+
+        link = tree.get_node(edge.linkFrom).get_link(edge.to)
+
+        I.append(pos[edge.linkFrom])
+        J.append(pos[edge.to])
+        W.append(N.nan if link.weight is None else float(link.weight))
+        methods.append(link.method)
+
+    return N.array(names), N.array(I, dtype=int), N.array(J, dtype=int), N.array(W, dtype=N.float32), N.array(methods, dtype=str)
+
+def visml_adjacency(filename, methods=None, sparse=False):
+    """
+
+    Reads the VisML file filename straight into an adjacency matrix, without building a VisMLTree.
+
+    Returns (names, M), where names are the sorted node names and M[i][j] is the weight of the link from node i
+    to node j, or 1 if it has none. Only links whose method is in methods are used, if given.
+    If a pair has more than one link, the last one in the file is used.
+
+    M is a dense float32 array, or a scipy.sparse csr_matrix if sparse is True
 
     """
 
     from pyvisml import VisML
 
-    A = VisML.VisMLTree(tree)
-    
-    Anodes = {}
-    for k in A.nodes:
-        Anodes[k.name] = k
+    names, src, to, meth, W = VisML.read_links(filename)
 
-    sample_ids = Anodes.keys()
-    sample_ids.sort()
+    if methods:
+        keep = N.in1d(meth, list(methods))
+        src, to, W = src[keep], to[keep], W[keep]
 
-    M = N.zeros((len(sample_ids), len(sample_ids)), dtype=N.float32)
+    snames, rank = N.unique(names, return_inverse=True)
 
-    Midx = {}
-    for i in xrange(len(sample_ids)):
-        Midx[sample_ids[i]] = i
+    I = rank.take(src)
+    J = N.searchsorted(snames, to)
 
-    for k in sample_ids:
-        for link in Anodes[k].links:
-            
-            if methods:
-                if link.method not in methods:
-                    continue
+    missing = (J == len(snames)) | (snames.take(J, mode='clip') != to)
+    if missing.any():
+        raise KeyError, 'Link to unknown node %s' % to[missing][0]
 
-            i = Midx[k]
-            j = Midx[link.to]
+    W[N.isnan(W)] = 1.0
 
-            if link.weight is not None:
-                M[i][j] = float(link.weight)
-            else:
-                M[i][j] = 1.0
+    # Keep the last link for each pair
+    n    = len(snames)
+    pair = I.astype(N.int64) * n + J
+    last = len(pair) - 1 - N.unique(pair[::-1], return_index=True)[1]
+    I, J, W = I[last], J[last], W[last].astype(N.float32)
+
+    if sparse:
+        from scipy.sparse import csr_matrix
+        M = csr_matrix((W, (I, J)), shape=(n, n))
+    else:
+        M = N.zeros((n, n), dtype=N.float32)
+        M[I, J] = W
+
+    return snames, M
+
+def create_sdata_from_visml(tree, methods=[]):
+    """
+    Creates a symmetric SampleData object from tree, a VisML filename, incorporating only those links in methods if given
+
+    """
+
+    sample_ids, M = visml_adjacency(tree, methods)
 
     assert (M == M.T).all()
 
     c = parsers.NullParser()
     c.M = M
-    c.gene_names = N.array(sample_ids)
-    c.samples = [ parsers.SampleData(sample_id=x) for x in c.gene_names ]
+    c.gene_names = sample_ids
+    c.samples = parsers.SampleTable(c.gene_names)
 
     return c
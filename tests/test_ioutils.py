@@ -0,0 +1,61 @@
+"""
+
+Tests for clustio.ioutils
+
+Run from the top of the repository with python -m unittest discover -s tests -t .
+
+"""
+import os, gzip, bz2, shutil, tempfile, unittest
+
+from clustio import ioutils
+
+DATA = ''.join([ 'gene%d\t%s\n' % (i, '\t'.join([ str(i * j) for j in xrange(10) ])) for i in xrange(20000) ])
+
+
+class TestDecompressingReader(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dir = tempfile.mkdtemp()
+
+        self.files = {}
+        for kind, opener in (('gzip', gzip.open), ('bz2', bz2.BZ2File)):
+            fn = os.path.join(self.dir, 'data.%s' % kind)
+            f = opener(fn, 'wb')
+            f.write(DATA)
+            f.close()
+            self.files[kind] = open(fn, 'rb').read()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.dir)
+
+    def read(self, content):
+
+        fn = os.path.join(self.dir, 'test')
+
+        f = open(fn, 'wb')
+        f.write(content)
+        f.close()
+
+        f = ioutils.open_file(fn)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_complete(self):
+
+        for kind, raw in self.files.items():
+            self.assertEqual(self.read(raw), DATA)
+            self.assertEqual(self.read(raw + raw), DATA + DATA)
+
+    def test_truncated(self):
+
+        for kind, raw in self.files.items():
+            for size in (len(raw) // 2, len(raw) - 1, len(raw) + len(raw) // 2):
+                self.assertRaises(IOError, self.read, (raw + raw)[:size])
+
+
+if __name__ == '__main__':
+    unittest.main()
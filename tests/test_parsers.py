@@ -0,0 +1,96 @@
+"""
+
+Tests for clustio.parsers
+
+Run from the top of the repository with python -m unittest discover -s tests -t .
+
+"""
+import unittest
+import cPickle as cp
+
+from clustio import parsers
+
+# A NullParser with two SampleData samples, pickled by the list-based parsers before SampleTable
+BASELINE_PICKLES = {
+    0: "ccopy_reg\n_reconstructor\np0\n(cclustio.parsers\nNullParser\np1\nc__builtin__\nobject\np2\nNtp3\nRp4\n(dp5\n"
+       "S'gene_names'\np6\n(lp7\nS'g0'\np8\naS'g1'\np9\nasS'samples'\np10\n(lp11\ng0\n(cclustio.parsers\nSampleData\n"
+       "p12\ng2\nNtp13\nRp14\n(dp15\nS'index'\np16\nI0\nsS'sample_id'\np17\nS's0'\np18\nsS'cluster_id'\np19\nNsS'sample_num'\n"
+       "p20\nI1\nsS'sample_class'\np21\nS'a'\np22\nsbag0\n(g12\ng2\nNtp23\nRp24\n(dp25\ng16\nI1\nsg17\nS's1'\np26\nsg19\nI3\n"
+       "sg20\nI2\nsg21\nS'b'\np27\nsbasb.",
+    2: "\x80\x02cclustio.parsers\nNullParser\nq\x00)\x81q\x01}q\x02(U\ngene_namesq\x03]q\x04(U\x02g0q\x05U\x02g1q\x06eU\x07"
+       "samplesq\x07]q\x08(cclustio.parsers\nSampleData\nq\t)\x81q\n}q\x0b(U\x05indexq\x0cK\x00U\tsample_idq\rU\x02s0q\x0eU\n"
+       "cluster_idq\x0fNU\nsample_numq\x10K\x01U\x0csample_classq\x11U\x01aq\x12ubh\t)\x81q\x13}q\x14(h\x0cK\x01h\rU\x02s1q"
+       "\x15h\x0fK\x03h\x10K\x02h\x11U\x01bq\x16ubeub.",
+}
+
+
+class TestBaselinePickles(unittest.TestCase):
+
+    def check(self, c):
+
+        self.assertTrue(isinstance(c.samples, parsers.SampleTable))
+        self.assertEqual(c.samples.sample_id, ['s0', 's1'])
+        self.assertEqual(c.samples.sample_num, [1, 2])
+        self.assertEqual(c.samples.sample_class, ['a', 'b'])
+        self.assertEqual(c.samples.cluster_id, [None, 3])
+        self.assertEqual(c.samples.index, [0, 1])
+        self.assertEqual(c.sample_index, {'s0': 0, 's1': 1})
+
+    def test_protocol_0(self):
+
+        self.check(cp.loads(BASELINE_PICKLES[0]))
+
+    def test_protocol_2(self):
+
+        self.check(cp.loads(BASELINE_PICKLES[2]))
+
+    def test_roundtrip(self):
+
+        c = cp.loads(BASELINE_PICKLES[2])
+
+        for proto in (0, 2):
+            self.check(cp.loads(cp.dumps(c, proto)))
+
+            sample = cp.loads(cp.dumps(c.samples[1], proto))
+            self.assertEqual((sample.sample_id, sample.cluster_id), ('s1', 3))
+
+
+class TestSampleIndex(unittest.TestCase):
+
+    def setUp(self):
+
+        self.c = parsers.NullParser()
+        self.c.samples = parsers.SampleTable(['s0', 's1', 's2'])
+
+    def test_row_write(self):
+
+        self.assertEqual(self.c.sample_index['s0'], 0)
+
+        self.c.samples[0].sample_id = 'renamed'
+        self.assertEqual(self.c.sample_index, {'renamed': 0, 's1': 1, 's2': 2})
+
+    def test_column_write(self):
+
+        self.assertEqual(self.c.sample_index['s2'], 2)
+
+        self.c.samples.sample_id = ['a', 'b', 'c']
+        self.assertEqual(self.c.sample_index, {'a': 0, 'b': 1, 'c': 2})
+
+    def test_table_edits(self):
+
+        samples = self.c.samples
+        self.assertEqual(self.c.sample_index['s1'], 1)
+
+        samples[1] = parsers.SampleData('x')
+        self.assertEqual(self.c.sample_index['x'], 1)
+
+        del samples[0]
+        samples.append(parsers.SampleData('y'))
+        self.assertEqual(self.c.sample_index, {'x': 0, 's2': 1, 'y': 2})
+
+        samples.extend([ parsers.SampleData('z') ])
+        self.assertEqual(self.c.sample_index['z'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
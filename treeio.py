@@ -22,30 +22,45 @@ along with Crosstalker.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 from pyvisml import VisML
-import clustio, scripts
-from itertools import combinations as comb
+import auc, clustio, scripts
 
+import os
 import numpy as N
 import cPickle as cp
 
 NO_COMPARISON_SUFFIX = 'no_comparison'
 COMPARISON_SUFFIX    = 'final'
 
+SIG_FILE      = 'sig_connections/%s_sig_connections_999.npz' # Significant connections for a condition, an edge list written by clustio.write_edges
+SIG_TEXT_FILE = 'sig_connections/%s_sig_connections_999.txt' # Older dense matrix of significant connections, used if no edge list is found
+
 # XXX requires pathway definitions
 
-def difftree(pathway_dict, test_cond_name, control_cond_name, infile_suffix=NO_COMPARISON_SUFFIX):            
-    # To be performed on freshly created scripts.create_visml_from_sdata(%s_sig_connections.txt, dmatrix=True)
+def read_sig_connections(cond_name):
+    """Returns the significant connections for cond_name as a symmetric matrix, from its edge list if there is one"""
+
+    if os.path.exists(SIG_FILE % cond_name):
+        return clustio.ParseEdges(SIG_FILE % cond_name)
+
+    return clustio.ParseNormal(SIG_TEXT_FILE % cond_name)
+
+def difftree(pathway_dict, test_cond_name, control_cond_name, infile_suffix=NO_COMPARISON_SUFFIX, tree=None):            
+    # To be performed on a freshly created sig_tree(test_cond_name)
+    # If tree is given it is used (and modified) in place of the one in %s_%s.xml % (test_cond_name, infile_suffix),
+    # or in %s_%s.xml.gz if only the compressed network was written
     
-    A = VisML.VisMLTree('%s_%s.xml' % (test_cond_name, infile_suffix))
-    B = clustio.ParseNormal('sig_connections/%s_sig_connections_999.txt' % control_cond_name)
+    A = tree
+    if A is None:
+        fn = '%s_%s.xml' % (test_cond_name, infile_suffix)
+        if not os.path.exists(fn) and os.path.exists(fn + '.gz'):
+            fn += '.gz'
+        A = VisML.VisMLTree(fn)
+    B = read_sig_connections(control_cond_name)
     C = clustio.ParseNormal('auc_results/%s_results_reweight_RAW.txt' % test_cond_name)
     D = clustio.ParseNormal('auc_results/%s_results_reweight_RAW.txt' % control_cond_name)
     assert len(C) == len(D)
-    for i, j in comb(xrange(len(C)), 2):
-        vC = N.sqrt(C.M[i][j] * C.M[j][i])
-        vD = N.sqrt(D.M[i][j] * D.M[j][i])
-        C.M[i][j] = C.M[j][i] = vC
-        D.M[i][j] = D.M[j][i] = vD
+    C.M = auc.mutual_matrix(C.M)
+    D.M = auc.mutual_matrix(D.M)
     A.add_method('M8002', 'Enhanced in %s vs Normal' % test_cond_name, 'C', color='purple')
     A.add_method('M8003', 'Enhanced in Normal vs %s' % test_cond_name, 'C', color='green')
     A.add_method('M7000', 'Abnormal Link', 'C', color='red')
@@ -58,41 +73,53 @@ def difftree(pathway_dict, test_cond_name, control_cond_name, infile_suffix=NO_C
     f.close()
 
     nodenames = And.keys()
-    for i, j in comb(xrange(len(nodenames)), 2):
-        n1 = nodenames[i]
-        n2 = nodenames[j]
-        p1 = set(pathway_dict[n1.lower()])
-        p2 = set(pathway_dict[n2.lower()])
-        thresh = comp[(len(p1), len(p2), len(p1 & p2))]
-        wB = B.get_samples([n1.lower()]).get_features([n2.lower()]).M[0][0]
-        wA = 0.0
-        if A.isconnected(n1, n2):
-            wA = float([ edge.weight for edge in And[n1].links if edge.target == n2 ][0])
-        wC = C.get_samples([n1.lower()]).get_features([n2.lower()]).M[0][0]
-        wD = D.get_samples([n1.lower()]).get_features([n2.lower()]).M[0][0]
-        meth = None
-        if wA and wB:
-            if thresh and (wC - wD) >= thresh:
-                meth = 'M8002'
-            elif thresh and (wD - wC) >= thresh:
-                meth = 'M8003'
-            else:
-                meth = 'M0099'
-        elif wA and not wB:
-            if thresh and (wC - wD) >= thresh:
-                meth = 'M7000'
-            else:
-                meth = 'M0099'
-        elif wB and not wA:
-            meth = 'M7001'
-        if meth is not None:
-            if meth == 'M7001':
-                A.add_edge(And[n1], And[n2], method=meth)
-            else:
-                link1 = [ link for link in And[n1].links if link.target == n2 ][0]
-                link2 = [ link for link in And[n2].links if link.target == n1 ][0]
-                link1.method = meth
-                link2.method = meth
+    lnames    = [ x.lower() for x in nodenames ]
+    pos       = dict([ (nodenames[i], i) for i in xrange(len(nodenames)) ])
+
+    edge_dict = A._edges._edge_dict
+    conn = N.zeros((len(nodenames), len(nodenames)), dtype=bool)
+    for n1 in edge_dict:
+        if n1 in pos:
+            conn[pos[n1], [ pos[n2] for n2 in edge_dict[n1] if n2 in pos ]] = True
+
+    # The links of A aligned to nodenames, and the weights of the connected pairs in the upper triangle,
+    # the only ones read below. Other links, such as M7001 ones, may have no weight
+    WA    = N.zeros(conn.shape, dtype=N.float64)
+    links = {}
+    for n1 in nodenames:
+        i = pos[n1]
+        for link in And[n1].links:
+            j = pos.get(link.target)
+            if j is not None and (i, j) not in links:
+                links[(i, j)] = link
+                if i < j and conn[i, j]:
+                    WA[i][j] = float(link.weight)
+
+    thresh = auc.threshold_matrix(lnames, pathway_dict, comp)
+    WB, WC, WD = [ X.M[N.ix_([ X.sample_index[x] for x in lnames ], [ X.gene_index[x] for x in lnames ])] for X in (B, C, D) ]
+
+    a = WA != 0
+    b = WB != 0
+    up   = (thresh != 0) & ((WC - WD).astype(N.float64) >= thresh)
+    down = (thresh != 0) & ((WD - WC).astype(N.float64) >= thresh)
+
+    meth = N.zeros(WA.shape, dtype='S5')
+    meth[a | b] = 'M0099'
+    meth[a & b & down] = 'M8003'
+    meth[a & up] = N.where(b, 'M8002', 'M7000')[a & up]
+    meth[b & ~a] = 'M7001'
+
+    # Only the upper triangle is used, in the same order as every pair of nodenames
+    meth[N.tril_indices(len(nodenames))] = ''
+
+    for i, j in N.transpose(N.nonzero(meth)):
+        m = str(meth[i][j])
+        if m == 'M7001':
+            A.add_edge(And[nodenames[i]], And[nodenames[j]], method=m)
+        else:
+            for link in (links[(i, j)], links[(j, i)]):
+                if link.method != m:
+                    link.method = m
     return A
 
 def prettify_tree(tree):
@@ -111,14 +138,50 @@ def prettify_tree(tree):
 
     return tree
 
-def create_tree(test_cond_name, control_cond_name, pathway_dict, infile_suffix=NO_COMPARISON_SUFFIX, outfile_suffix=COMPARISON_SUFFIX):
+def sig_tree(test_cond_name):
+    """
+
+    Builds the prettified network of significant connections for test_cond_name, without any comparison.
+    The network is built straight from the edge list if there is one, rather than by scanning the matrix
+
+    """
+
+    if os.path.exists(SIG_FILE % test_cond_name):
+        tree = scripts.create_visml_from_edges(SIG_FILE % test_cond_name)
+    else:
+        tree = scripts.create_visml_from_sdata(clustio.ParseNormal(SIG_TEXT_FILE % test_cond_name), dmatrix=True)
+
+    return prettify_tree(tree)
+
+def create_tree(test_cond_name, control_cond_name, pathway_dict, infile_suffix=NO_COMPARISON_SUFFIX, outfile_suffix=COMPARISON_SUFFIX, write_intermediate=True, compress=False, edge_list=False):
+    """
+
+    Writes the final comparison network %s_%s.xml % (test_cond_name, outfile_suffix)
+
+    The network is built once in memory and passed straight to difftree rather than re-parsed from disk.
+    The network without comparison, %s_%s.xml % (test_cond_name, infile_suffix), is only written if
+    write_intermediate is True
+
+    If compress is True both are gzipped, and .gz is added to their names
+
+    If edge_list is True, the final network is also written as an edge list, %s_%s.npz % (test_cond_name, outfile_suffix),
+    with each edge's link method as its category. See clustio.write_edges
+
+    """
+
+    ext = compress and '.xml.gz' or '.xml'
 
     print
-    print('Creating VisML tree %s_%s.xml...' % (test_cond_name, infile_suffix))
-    tree = scripts.create_visml_from_sdata(clustio.ParseNormal('sig_connections/%s_sig_connections_999.txt' % test_cond_name), dmatrix=True)
-    tree = prettify_tree(tree)
-    tree.write('%s_%s.xml' % (test_cond_name, infile_suffix))
-
-    print('Creating VisML tree %s_%s.xml...' % (test_cond_name, outfile_suffix))
-    tree = difftree(pathway_dict, test_cond_name, control_cond_name, infile_suffix=infile_suffix)
-    tree.write('%s_%s.xml' % (test_cond_name, outfile_suffix))
+    print('Creating VisML tree %s_%s%s...' % (test_cond_name, infile_suffix, ext))
+    tree = sig_tree(test_cond_name)
+
+    if write_intermediate:
+        tree.write('%s_%s%s' % (test_cond_name, infile_suffix, ext))
+
+    print('Creating VisML tree %s_%s%s...' % (test_cond_name, outfile_suffix, ext))
+    tree = difftree(pathway_dict, test_cond_name, control_cond_name, infile_suffix=infile_suffix, tree=tree)
+    tree.write('%s_%s%s' % (test_cond_name, outfile_suffix, ext))
+
+    if edge_list:
+        names, I, J, W, methods = scripts.visml_edges(tree)
+        clustio.write_edges(names, I, J, W, '%s_%s.npz' % (test_cond_name, outfile_suffix), methods)